@@ -1,406 +1,388 @@
 import os
-import uuid
-import subprocess
+import base64
+import hashlib
+import asyncio
+import shutil
+import time
+from datetime import datetime
+from typing import List, Literal, Optional
+from functools import partial
 from fastapi import HTTPException
-import librosa
-import numpy as np
 import json
-import jwt
-from fastapi import APIRouter, Depends, File, UploadFile
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from app.schemas import AnalyzeLinkRequest, AnalyzeResponse
-from app.config import JWT_SECRET_KEY
-from app.database import get_db, SongHistory
-from fastapi.responses import FileResponse, Response
-from scipy.ndimage import median_filter, gaussian_filter1d
-from scipy.signal import correlate, medfilt
-from music21 import key as m21key, chord as m21chord, roman, pitch as m21pitch, stream
-from collections import Counter
+from fastapi import APIRouter, Depends, File, Form, Query, Request, UploadFile
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+from app.schemas import AnalyzeLinkRequest, AnalyzeResponse, AnalysisJobResponse, BatchLinkRequest, BatchResponse, HistoryPage, Vocabulary
+from app.config import (
+    AUDIO_STORAGE_CODEC, BATCH_MAX_ITEMS, BATCH_MAX_FILES, BATCH_CONCURRENCY,
+    MAX_AUDIO_DURATION_SECONDS, MAX_FILE_DURATION_SECONDS
+)
+from app.auth import Principal, get_current_user
+from app.async_database import get_async_db
+from app.database import SessionLocal, SongHistory
+from app.analyzer import analyze_with_timings, pcm_decode_command, AudioFileStream, SAMPLE_RATE
+from app.chords import DEFAULT_VOCABULARY
+from app.cache import (
+    link_cache_key, pcm_cache_key, find_cached_analysis, remember_analysis, invalidate_analysis_cache
+)
+from app.metrics import AUDIO_DURATION, JOBS_FINISHED, REALTIME_FACTOR
+from app.jobs import (
+    AnalysisJob, AnalysisBatch, create_job, get_job, create_batch, get_batch, start_background,
+    STAGE_DOWNLOADING, STAGE_CONVERTING, STAGE_ANALYZING, STAGE_STORING
+)
+from app.chord_codec import encode_chords, load_chords
+from app.audio_codec import encode_audio_file, iter_transcode_to_wav, AUDIO_CODECS
+from app.playback import audio_response, streamed_audio_response, bytes_opener, STREAM_CHUNK_BYTES
+from app.storage import get_storage, store_audio_file, migrate_song_audio, release_audio_async
+from app.uploads import save_upload, check_audio_window, raise_too_long
+from app.youtube import download_audio, expand_playlist
+from app.workers import (
+    analysis_slot, reserve_analysis_slot, release_analysis_slot, wait_for_analysis_slot,
+    run_in_worker_with_progress
+)
+from fastapi.responses import StreamingResponse
 
 # --- Constantes ---
-TITLE_NOT_FOUND = "Título no encontrado"
-AUDIO_FILENAME = "audio.wav"
-AUDIO_WEBM = "audio.webm"
+# Bytes leídos de cada vez de la salida PCM de ffmpeg
+PCM_CHUNK_BYTES = 1 << 20
 
 
-def verify_token(token: str):
+router = APIRouter()
+
+# ----------------------------
+# FUNCIÓN: Validar y medir el audio (FFmpeg)
+# ----------------------------
+async def scan_audio(audio: AudioFileStream, max_seconds: int) -> str:
+    """Decodifica el audio a PCM por trozos para validarlo, medir su duración y
+    calcular el hash de sus muestras (la clave de caché), sin guardarlo en memoria.
+
+    Rellena audio.n_samples y devuelve el SHA-256 del PCM float32 mono a SAMPLE_RATE.
+    Si max_seconds no es 0, ffmpeg se detiene poco después de ese máximo y el
+    audio más largo se rechaza.
+    """
+    length = audio.length
+    if length is None and max_seconds:
+        # Un segundo de margen para distinguir "justo el máximo" de "más largo"
+        length = max_seconds + 1
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expirado. Por favor, inicia sesión de nuevo.")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Token inválido. No autorizado.")
+        proc = await asyncio.create_subprocess_exec(
+            *pcm_decode_command(audio.path, audio.start, length),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=500,
+            detail="FFmpeg no está instalado. Por favor instala FFmpeg para convertir archivos de audio."
+        )
 
+    digest = hashlib.sha256()
 
-router = APIRouter()
+    async def read_pcm() -> int:
+        total = 0
+        while True:
+            chunk = await proc.stdout.read(PCM_CHUNK_BYTES)
+            if not chunk:
+                return total
+            digest.update(chunk)
+            total += len(chunk)
 
-# --- Constantes para análisis avanzado ---
-NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+    # stderr se lee a la vez para que ffmpeg no se bloquee si se llena la tubería
+    total, stderr = await asyncio.gather(read_pcm(), proc.stderr.read())
+    await proc.wait()
 
-# Perfiles Krumhansl para detección de tonalidad
-KRUMHANSL_MAJOR = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
-KRUMHANSL_MINOR = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
+    if proc.returncode != 0:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error decodificando el audio: {stderr.decode(errors='replace')}"
+        )
 
-# ---------------------------
-# 1. Detectar tonalidad usando perfiles Krumhansl
-# ---------------------------
-def detect_key_krumhansl(chroma):
-    """Detecta la tonalidad usando perfiles Krumhansl-Schmuckler"""
-    mean_chroma = chroma.mean(axis=1)
-    mean_chroma = mean_chroma / (mean_chroma.sum() + 1e-8)
-    
-    major_scores = []
-    minor_scores = []
-    for i in range(12):
-        major_scores.append(np.dot(np.roll(KRUMHANSL_MAJOR, i), mean_chroma))
-        minor_scores.append(np.dot(np.roll(KRUMHANSL_MINOR, i), mean_chroma))
-    
-    maj_best = int(np.argmax(major_scores))
-    min_best = int(np.argmax(minor_scores))
-    
-    if major_scores[maj_best] >= minor_scores[min_best]:
-        return NOTE_NAMES[maj_best], 'major', major_scores[maj_best]
-    else:
-        return NOTE_NAMES[min_best], 'minor', minor_scores[min_best]
-
-
-# -------------------------
-# Estimación del número de beats por compás
-# -------------------------
-def estimate_beats_per_bar(y, sr, beats_frames):
-    """Estima el número de beats por compás usando autocorrelación"""
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-    beat_strengths = []
-    for i in range(len(beats_frames)-1):
-        s = beats_frames[i]
-        e = beats_frames[i+1]
-        beat_strengths.append(onset_env[s:e].mean() if e>s else onset_env[s])
-    
-    beat_strengths = np.array(beat_strengths)
-    
-    if len(beat_strengths) < 6:
-        return 4
-    
-    ac = correlate(beat_strengths - beat_strengths.mean(), 
-                   beat_strengths - beat_strengths.mean(), mode='full')
-    mid = len(ac)//2
-    ac_segment = ac[mid+1: mid+1+16]
-    
-    candidates = ac_segment[2:8] if len(ac_segment) >= 8 else ac_segment
-    if len(candidates) == 0:
-        return 4
-    
-    best = int(np.argmax(candidates)) + 3
-    return best
-
-
-# -------------------------
-# Plantillas de acordes
-# -------------------------
-def build_chord_templates():
-    """Construye plantillas de acordes básicos para detección más robusta."""
-    intervals_map = {
-        "": [(0, 1.0), (4, 0.95), (7, 0.9)],              # Mayor
-        "m": [(0, 1.0), (3, 0.95), (7, 0.9)],             # Menor
-        "7": [(0, 1.0), (4, 0.85), (7, 0.8), (10, 0.7)],      # Dominante 7
-        "m7": [(0, 1.0), (3, 0.85), (7, 0.8), (10, 0.7)],     # Menor 7
-        "maj7": [(0, 1.0), (4, 0.85), (7, 0.8), (11, 0.7)],   # Mayor 7
-    }
-    
-    templates = {}
-    for r_idx, root in enumerate(NOTE_NAMES):
-        for suf, intervals in intervals_map.items():
-            vec = np.zeros(12)
-            for semitone, weight in intervals:
-                vec[(r_idx + semitone) % 12] = weight
-            norm = np.linalg.norm(vec)
-            if norm > 0:
-                vec = vec / norm
-            label = root + suf
-            templates[label] = vec
-    
-    return templates
-
-
-# -------------------------
-# Detectar nota de bajo dominante en un segmento
-# -------------------------
-def detect_bass_in_segment(y_segment, sr):
-    """Detecta la nota de bajo dominante en un segmento de audio"""
-    if len(y_segment) < 1024:
-        return None
-    
-    n_fft = min(4096, len(y_segment))
-    chroma = librosa.feature.chroma_cqt(y=y_segment, sr=sr, n_chroma=12, n_octaves=2)
-    if chroma.size == 0:
-        return None
-    bass_profile = chroma.mean(axis=1)
-    return int(np.argmax(bass_profile))
+    n_samples = total // 4
+    if n_samples == 0:
+        raise HTTPException(status_code=400, detail="Audio inválido o vacío.")
+    if max_seconds and n_samples > max_seconds * SAMPLE_RATE:
+        raise_too_long(n_samples / SAMPLE_RATE, max_seconds)
+    audio.n_samples = n_samples
+    return digest.hexdigest()
 
 
-# -------------------------
-# Detectar acorde en un segmento usando plantillas
-# -------------------------
-def detect_chord_in_segment(chroma_segment, templates, bass_hint=None):
-    """Detecta el acorde que mejor coincide con el segmento de chroma"""
-    if chroma_segment.size == 0:
-        return "N.C.", 0.0
-    
-    mean_chroma = chroma_segment.mean(axis=1)
-    norm = np.linalg.norm(mean_chroma)
-    if norm < 1e-6:
-        return "N.C.", 0.0
-    mean_chroma = mean_chroma / norm
-    
-    best_chord = "N.C."
-    best_score = -1.0
-    
-    for chord_name, template in templates.items():
-        score = np.dot(mean_chroma, template)
-        
-        if bass_hint is not None:
-            root_idx = NOTE_NAMES.index(chord_name.replace('m7','').replace('maj7','').replace('m','').replace('7',''))
-            if root_idx == bass_hint:
-                score *= 1.15
-        
-        if score > best_score:
-            best_score = score
-            best_chord = chord_name
-    
-    return best_chord, best_score
-
-
-# -------------------------
-# Análisis principal de audio
-# -------------------------
-def analyze_audio_advanced(audio_path: str):
-    """Análisis avanzado de audio con detección de acordes por compás"""
-    y, sr = librosa.load(audio_path, sr=22050)
-    
-    # Tempo y beats
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    if isinstance(tempo, np.ndarray):
-        tempo = float(tempo[0])
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-    
-    # Tonalidad
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-    key_root, key_mode, key_confidence = detect_key_krumhansl(chroma)
-    
-    # Estimar beats por compás
-    beats_per_bar = estimate_beats_per_bar(y, sr, beat_frames)
-    if beats_per_bar not in [3, 4]:
-        beats_per_bar = 4
-    
-    # Construir plantillas
-    templates = build_chord_templates()
-    
-    # Detectar acordes por compás
-    chords_result = []
-    num_beats = len(beat_times)
-    
-    bar_idx = 0
-    i = 0
-    while i < num_beats:
-        bar_start_beat = i
-        bar_end_beat = min(i + beats_per_bar, num_beats)
-        
-        start_time = beat_times[bar_start_beat]
-        end_time = beat_times[bar_end_beat - 1] if bar_end_beat > bar_start_beat else start_time
-        
-        if bar_end_beat < num_beats:
-            end_time = beat_times[bar_end_beat]
-        else:
-            end_time = librosa.get_duration(y=y, sr=sr)
-        
-        start_frame = librosa.time_to_frames(start_time, sr=sr)
-        end_frame = librosa.time_to_frames(end_time, sr=sr)
-        
-        if end_frame > start_frame and end_frame <= chroma.shape[1]:
-            chroma_segment = chroma[:, start_frame:end_frame]
-            
-            start_sample = int(start_time * sr)
-            end_sample = int(end_time * sr)
-            y_segment = y[start_sample:end_sample]
-            bass_hint = detect_bass_in_segment(y_segment, sr)
-            
-            chord, score = detect_chord_in_segment(chroma_segment, templates, bass_hint)
-        else:
-            chord = "N.C."
-        
-        chords_result.append({
-            "start_time": round(start_time, 2),
-            "end_time": round(end_time, 2),
-            "chord": chord,
-            "bar": bar_idx + 1
-        })
-        
-        bar_idx += 1
-        i += beats_per_bar
-    
-    # Agregar prevChord y nextChord
-    for idx, c in enumerate(chords_result):
-        c["prevChord"] = chords_result[idx - 1]["chord"] if idx > 0 else None
-        c["nextChord"] = chords_result[idx + 1]["chord"] if idx < len(chords_result) - 1 else None
-    
-    return {
-        "tempo_bpm": round(tempo, 1),
-        "key": key_root,
-        "mode": key_mode,
-        "beats_per_bar": beats_per_bar,
-        "chords": chords_result
-    }
+def offset_bars(bars: list, offset: float) -> list:
+    """Pasa los tiempos de los compases de un fragmento a tiempos de la canción entera"""
+    if offset:
+        for bar in bars:
+            bar["start_time"] = round(bar["start_time"] + offset, 2)
+            bar["end_time"] = round(bar["end_time"] + offset, 2)
+    return bars
 
 
 # ----------------------------
-# FUNCIÓN: Descargar audio con yt-dlp
+# PIPELINE: etapas de un análisis
 # ----------------------------
-def download_audio(youtube_url: str, output_dir: str) -> str:
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, AUDIO_WEBM)
-
-    # Comando actualizado para compatibilidad con restricciones de YouTube (dic 2025)
-    cmd = [
-        "yt-dlp",
-        "--no-check-certificate",
-        "--no-playlist",
-        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "--extractor-args", "youtube:player_client=web",
-        "-f", "bestaudio/best",
-        "--extract-audio",
-        "--audio-format", "best",
-        "-o", output_path,
-        youtube_url,
-    ]
-
+def save_song_history(**fields):
+    """Guarda un análisis en el historial (se ejecuta fuera del event loop)"""
+    db = SessionLocal()
     try:
-        result = subprocess.run(
-            cmd,
-            check=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=180
-        )
-    except subprocess.TimeoutExpired:
-        raise HTTPException(
-            status_code=408,
-            detail="Tiempo de descarga excedido. El video es demasiado largo o la conexión es lenta."
-        )
+        db.add(SongHistory(**fields))
+        db.commit()
+    finally:
+        db.close()
 
-    # Si falla, intentar configuración alternativa
-    if result.returncode != 0:
-        cmd_fallback = [
-            "yt-dlp",
-            "--no-check-certificate",
-            "--no-playlist",
-            "-f", "bestaudio/best",
-            "--extract-audio",
-            "-o", output_path,
-            youtube_url,
-        ]
+
+def copy_song_history(source_job_id: str, cache_key: str, **fields) -> bool:
+    """Crea una entrada de historial que comparte el audio de un análisis previo"""
+    db = SessionLocal()
+    try:
+        def find_source():
+            source = db.query(
+                SongHistory.id, SongHistory.audio_key, SongHistory.audio_size, SongHistory.audio_codec
+            ).filter(SongHistory.job_id == source_job_id).first()
+            if source is None:
+                # El análisis original pudo borrarse: vale cualquier otra copia del mismo audio
+                source = db.query(
+                    SongHistory.id, SongHistory.audio_key, SongHistory.audio_size, SongHistory.audio_codec
+                ).filter(SongHistory.cache_key == cache_key).order_by(SongHistory.analyzed_at.desc()).first()
+            return source
         
-        try:
-            result = subprocess.run(
-                cmd_fallback,
-                check=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=180
-            )
-        except subprocess.TimeoutExpired:
-            raise HTTPException(
-                status_code=408,
-                detail="Tiempo de descarga excedido."
-            )
+        source = find_source()
+        if source is not None and source.audio_key is None:
+            # Fila anterior al almacenamiento externo: se migra su audio antes de compartirlo
+            source = find_source() if migrate_song_audio(db, source.id) else None
+        if source is None:
+            return False
         
-        if result.returncode != 0:
-            stderr = result.stderr.decode()
-            raise HTTPException(
-                status_code=400,
-                detail=f"No se pudo descargar el audio. El vídeo puede tener copyright o protección.\nDetalles: {stderr}"
-            )
+        db.add(SongHistory(
+            cache_key=cache_key,
+            audio_key=source.audio_key,
+            audio_size=source.audio_size,
+            audio_codec=source.audio_codec,
+            **fields
+        ))
+        db.commit()
+        return True
+    finally:
+        db.close()
+
 
-    # Buscar archivo descargado
-    possible_extensions = ['.webm', '.m4a', '.mp3', '.opus', '.ogg', '.wav']
-    actual_path = None
+async def reuse_cached_analysis(job: AnalysisJob, cache_key: str, youtube_url: str = None):
+    """Si el audio ya se analizó, crea la entrada del usuario sin repetir el análisis"""
+    entry = await asyncio.to_thread(find_cached_analysis, cache_key)
+    if not entry:
+        return None
     
-    if os.path.exists(output_path):
-        actual_path = output_path
-    else:
-        base_path = os.path.join(output_dir, "audio")
-        for ext in possible_extensions:
-            candidate = base_path + ext
-            if os.path.exists(candidate):
-                actual_path = candidate
-                break
-    
-    if not actual_path:
-        for f in os.listdir(output_dir):
-            if any(f.endswith(ext) for ext in possible_extensions):
-                actual_path = os.path.join(output_dir, f)
-                break
-    
-    if not actual_path:
-        raise HTTPException(
-            status_code=400,
-            detail="YouTube no proporcionó ningún archivo de audio sin protección."
+    job.set_stage(STAGE_STORING)
+    if not job.title:
+        job.title = entry["title"]
+    analysis = entry["analysis"]
+    
+    saved = await asyncio.to_thread(
+        copy_song_history,
+        entry["source_job_id"],
+        cache_key,
+        job_id=job.job_id,
+        user_id=job.user_id,
+        title=job.title,
+        source=job.source,
+        youtube_url=youtube_url,
+        tempo_bpm=analysis["tempo_bpm"],
+        key_detected=analysis["key"],
+        mode_detected=analysis["mode"],
+        beats_per_bar=analysis["beats_per_bar"],
+        chords_blob=encode_chords(analysis["chords"])
+    )
+    if not saved:
+        invalidate_analysis_cache(cache_key)
+        return None
+    
+    response = {
+        "job_id": job.job_id,
+        "analysis": analysis,
+        "title": job.title
+    }
+    job.finish(response)
+    return response
+
+
+async def analyze_and_store(
+    job: AnalysisJob, audio: AudioFileStream, vocabulary: str, cache_key: str = None, youtube_url: str = None,
+    offset: float = 0.0
+) -> dict:
+    """Analiza el audio en el pool de procesos y guarda el resultado en el historial.
+
+    El worker recibe solo la ruta del archivo y lo decodifica por bloques;
+    audio.n_samples ya lo ha medido scan_audio. offset es el inicio (en
+    segundos) del fragmento analizado dentro de la canción.
+    """
+    # Analizar en el pool de procesos, publicando los compases a medida que se detectan
+    job.set_stage(STAGE_ANALYZING)
+    job.audio_seconds = round(audio.n_samples / SAMPLE_RATE, 2)
+    started = time.perf_counter()
+    result, analysis_timings = await run_in_worker_with_progress(
+        analyze_with_timings, audio, vocabulary,
+        on_progress=lambda bars: job.add_partial_chords(offset_bars(bars, offset))
+    )
+    offset_bars(result["chords"], offset)
+    for stage, seconds in analysis_timings.items():
+        job.record_timing(stage, seconds)
+    # Lo que no es análisis: espera de un worker libre y arranque de la tarea en el proceso
+    job.record_timing("queue_wait", max(time.perf_counter() - started - sum(analysis_timings.values()), 0.0))
+    
+    job.set_stage(STAGE_STORING)
+    
+    # Comprimir el audio directamente desde el archivo original (ffmpeg de disco a disco)
+    audio_path = os.path.join(job.work_dir, f"stored.{AUDIO_CODECS[AUDIO_STORAGE_CODEC]['extension']}")
+    with job.timed("audio_encode"):
+        await asyncio.to_thread(encode_audio_file, audio, AUDIO_STORAGE_CODEC, audio_path)
+
+    # Guardar el audio y el historial
+    with job.timed("persistence"):
+        audio_key, audio_size = await asyncio.to_thread(store_audio_file, audio_path)
+        await asyncio.to_thread(
+            save_song_history,
+            job_id=job.job_id,
+            user_id=job.user_id,
+            title=job.title,
+            source=job.source,
+            youtube_url=youtube_url,
+            tempo_bpm=result["tempo_bpm"],  # Float, no convertir a int
+            key_detected=result["key"],
+            mode_detected=result["mode"],
+            beats_per_bar=result["beats_per_bar"],
+            chords_blob=encode_chords(result["chords"]),
+            audio_key=audio_key,
+            audio_size=audio_size,
+            audio_codec=AUDIO_STORAGE_CODEC,
+            cache_key=cache_key
         )
+    if cache_key:
+        remember_analysis(cache_key, job.job_id, job.title, result)
 
-    if os.path.getsize(actual_path) < 8000:
-        raise HTTPException(
-            status_code=400,
-            detail="Audio inválido o vacío. El vídeo no permite descarga legal."
-        )
+    response = {
+        "job_id": job.job_id,
+        "analysis": result,
+        "title": job.title
+    }
+    job.finish(response)
+    return response
+
+
+async def process_link_job(
+    job: AnalysisJob, youtube_url: str, vocabulary: str, start: float = None, end: float = None
+) -> dict:
+    # Reutilizar el análisis si otro usuario ya analizó este vídeo (o el mismo fragmento)
+    cache_key = link_cache_key(youtube_url, vocabulary, start, end)
+    if cache_key:
+        cached = await reuse_cached_analysis(job, cache_key, youtube_url=youtube_url)
+        if cached:
+            return cached
+
+    os.makedirs(job.work_dir, exist_ok=True)
+
+    # Descargar audio y metadatos en una sola extracción de yt-dlp
+    job.set_stage(STAGE_DOWNLOADING)
+    with job.timed("download"):
+        metadata, audio_path = await asyncio.to_thread(download_audio, youtube_url, job.work_dir, start, end)
+    if not job.title:
+        job.title = metadata["title"]
+
+    # Validar y medir el audio (yt-dlp ya recortó el fragmento, si se pidió)
+    audio = AudioFileStream(audio_path, length=None if end is None else end - (start or 0))
+    job.set_stage(STAGE_CONVERTING)
+    with job.timed("transcode"):
+        await scan_audio(audio, MAX_AUDIO_DURATION_SECONDS)
+
+    return await analyze_and_store(
+        job, audio, vocabulary, cache_key=cache_key, youtube_url=youtube_url, offset=start or 0.0
+    )
 
-    return actual_path
 
+async def process_upload_job(
+    job: AnalysisJob, file: UploadFile, vocabulary: str, start: float = None, end: float = None
+) -> dict:
+    # Guardar archivo subido por bloques
+    with job.timed("upload"):
+        upload_path = await save_upload(file, job.work_dir)
+    return await process_file_job(job, upload_path, vocabulary, start, end)
 
-# ----------------------------
-# FUNCIÓN: Convertir a WAV (FFmpeg)
-# ----------------------------
-def convert_to_wav(input_path: str, output_path: str):
-    cmd = [
-        "ffmpeg",
-        "-i", input_path,
-        "-ac", "1",
-        "-ar", "22050",
-        output_path,
-        "-y"
-    ]
 
+async def process_file_job(
+    job: AnalysisJob, upload_path: str, vocabulary: str, start: float = None, end: float = None
+) -> dict:
+    # Validar, medir y calcular el hash del audio (solo el fragmento start/end, si se pidió)
+    audio = AudioFileStream(upload_path, start, None if end is None else end - (start or 0))
+    job.set_stage(STAGE_CONVERTING)
+    with job.timed("transcode"):
+        pcm_digest = await scan_audio(audio, MAX_FILE_DURATION_SECONDS)
+
+    # El mismo audio decodificado da la misma clave aunque cambie el contenedor
+    cache_key = pcm_cache_key(pcm_digest, vocabulary, start, end)
+    cached = await reuse_cached_analysis(job, cache_key)
+    if cached:
+        return cached
+
+    return await analyze_and_store(job, audio, vocabulary, cache_key=cache_key, offset=start or 0.0)
+
+
+async def run_job(job: AnalysisJob, pipeline, error_prefix: str) -> dict:
+    """Ejecuta el pipeline y registra el error en el trabajo si falla"""
+    started = time.perf_counter()
     try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error convirtiendo a WAV: {e.stderr.decode()}"
-        )
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=500,
-            detail="FFmpeg no está instalado. Por favor instala FFmpeg para convertir archivos de audio."
-        )
+        response = await pipeline
+        JOBS_FINISHED.inc("done")
+        if job.audio_seconds:
+            # Solo los análisis calculados (no los servidos desde la caché)
+            AUDIO_DURATION.observe(job.audio_seconds)
+            REALTIME_FACTOR.observe((time.perf_counter() - started) / job.audio_seconds)
+        return response
+    except HTTPException as e:
+        JOBS_FINISHED.inc("failed")
+        job.fail(e.status_code, e.detail)
+        raise
+    except Exception as e:
+        JOBS_FINISHED.inc("failed")
+        job.fail(500, f"{error_prefix}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"{error_prefix}: {str(e)}")
+    finally:
+        job.record_timing("total", time.perf_counter() - started)
+        # Los archivos del trabajo (descarga o subida) ya no se necesitan
+        shutil.rmtree(job.work_dir, ignore_errors=True)
 
 
-# ----------------------------
-# FUNCIÓN: Obtener título de YouTube
-# ----------------------------
-def get_youtube_title(youtube_url: str) -> str:
-    """Extrae el título de un video de YouTube usando yt-dlp"""
+async def run_job_in_background(job: AnalysisJob, pipeline, error_prefix: str):
+    """Ejecuta el pipeline sin cliente esperando; libera el hueco reservado al terminar"""
     try:
-        result = subprocess.run(
-            ["yt-dlp", "--get-title", "--no-playlist", youtube_url],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        if result.returncode == 0:
-            return result.stdout.strip()
-        return TITLE_NOT_FOUND
-    except Exception:
-        return TITLE_NOT_FOUND
+        await run_job(job, pipeline, error_prefix)
+    except HTTPException:
+        # El error ya queda registrado en el trabajo
+        pass
+    finally:
+        release_analysis_slot()
+
+
+async def run_batch(batch: AnalysisBatch, items: list):
+    """Ejecuta los trabajos de un lote, como mucho BATCH_CONCURRENCY a la vez.
+
+    items son tuplas (job, pipeline, error_prefix). Cada elemento espera un
+    hueco de análisis en lugar de recibir 503, y su resultado se guarda en el
+    historial en cuanto termina, sin esperar al resto del lote.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_item(job: AnalysisJob, pipeline, error_prefix: str):
+        async with semaphore:
+            await wait_for_analysis_slot()
+            await run_job_in_background(job, pipeline, error_prefix)
+    
+    await asyncio.gather(*(run_item(*item) for item in items))
+
+
+def job_accepted(request: Request, job: AnalysisJob) -> dict:
+    return {
+        "job_id": job.job_id,
+        "stage": job.stage,
+        "status_url": str(request.url_for("get_job_status", job_id=job.job_id)),
+        "events_url": str(request.url_for("get_job_events", job_id=job.job_id))
+    }
 
 
 # ----------------------------
@@ -410,64 +392,16 @@ def get_youtube_title(youtube_url: str) -> str:
 @router.post("/analyze/link", response_model=AnalyzeResponse)
 async def analyze_link(
     req: AnalyzeLinkRequest,
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
-    db: Session = Depends(get_db)
+    user: Principal = Depends(get_current_user)
 ):
-    # Verificar token
-    token = credentials.credentials
-    payload = verify_token(token)
-    user_id = payload.get("user_id")
-    
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
+    user_id = user.user_id
+    check_audio_window(req.start, req.end)
     
-    try:
-        job_id = str(uuid.uuid4())
-        job_dir = os.path.join("jobs", job_id)
-        os.makedirs(job_dir, exist_ok=True)
-
-        # Obtener título
-        title = get_youtube_title(req.youtube_url)
-
-        # Descargar audio
-        audio_path = download_audio(req.youtube_url, job_dir)
-
-        # Convertir a WAV
-        wav_path = os.path.join(job_dir, AUDIO_FILENAME)
-        convert_to_wav(audio_path, wav_path)
-
-        # Analizar
-        result = analyze_audio_advanced(wav_path)
-        
-        # Leer archivo WAV para almacenarlo en BD
-        with open(wav_path, 'rb') as audio_file:
-            audio_data = audio_file.read()
-
-        # Guardar en historial
-        song_entry = SongHistory(
-            job_id=job_id,
-            user_id=user_id,
-            title=title,
-            source="youtube",
-            youtube_url=req.youtube_url,
-            tempo_bpm=result["tempo_bpm"],  # Float, no convertir a int
-            key_detected=result["key"],
-            mode_detected=result["mode"],
-            chords_json=json.dumps(result["chords"]),
-            audio_data=audio_data
+    async with analysis_slot():
+        job = create_job(user_id, "youtube")
+        return await run_job(
+            job, process_link_job(job, req.youtube_url, req.vocabulary, req.start, req.end), "Error procesando enlace"
         )
-        db.add(song_entry)
-        db.commit()
-
-        return {
-            "job_id": job_id,
-            "analysis": result,
-            "title": title
-        } 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error procesando enlace: {str(e)}")
 
 
 # ----------------------------
@@ -477,68 +411,196 @@ async def analyze_link(
 @router.post("/analyze/file", response_model=AnalyzeResponse)
 async def analyze_file(
     file: UploadFile = File(...),
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
-    db: Session = Depends(get_db)
+    vocabulary: Vocabulary = Form(DEFAULT_VOCABULARY),
+    start: Optional[float] = Form(None, ge=0),
+    end: Optional[float] = Form(None, gt=0),
+    user: Principal = Depends(get_current_user)
 ):
-    # Verificar token
-    token = credentials.credentials
-    payload = verify_token(token)
-    user_id = payload.get("user_id")
+    user_id = user.user_id
+    check_audio_window(start, end, MAX_FILE_DURATION_SECONDS)
     
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
+    async with analysis_slot():
+        job = create_job(user_id, "file", title=file.filename or "Archivo subido")
+        return await run_job(job, process_upload_job(job, file, vocabulary, start, end), "Error procesando archivo")
+
+
+# ----------------------------
+# ENDPOINTS /jobs - Análisis asíncronos
+# ----------------------------
+@router.post("/jobs", response_model=AnalysisJobResponse, status_code=202)
+async def create_link_job(
+    req: AnalyzeLinkRequest,
+    request: Request,
+    user: Principal = Depends(get_current_user)
+):
+    """Encola el análisis de un enlace y devuelve el job_id inmediatamente"""
+    user_id = user.user_id
+    check_audio_window(req.start, req.end)
     
+    reserve_analysis_slot()
+    job = create_job(user_id, "youtube")
+    start_background(run_job_in_background(
+        job, process_link_job(job, req.youtube_url, req.vocabulary, req.start, req.end), "Error procesando enlace"
+    ))
+    return job_accepted(request, job)
+
+
+@router.post("/jobs/file", response_model=AnalysisJobResponse, status_code=202)
+async def create_file_job(
+    request: Request,
+    file: UploadFile = File(...),
+    vocabulary: Vocabulary = Form(DEFAULT_VOCABULARY),
+    start: Optional[float] = Form(None, ge=0),
+    end: Optional[float] = Form(None, gt=0),
+    user: Principal = Depends(get_current_user)
+):
+    """Guarda el archivo, encola su análisis y devuelve el job_id"""
+    user_id = user.user_id
+    check_audio_window(start, end, MAX_FILE_DURATION_SECONDS)
+    
+    reserve_analysis_slot()
+    job = create_job(user_id, "file", title=file.filename or "Archivo subido")
     try:
-        job_id = str(uuid.uuid4())
-        job_dir = os.path.join("jobs", job_id)
-        os.makedirs(job_dir, exist_ok=True)
+        # El archivo debe guardarse antes de responder: UploadFile se cierra al terminar la petición
+        with job.timed("upload"):
+            upload_path = await save_upload(file, job.work_dir)
+    except Exception as e:
+        release_analysis_slot()
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        job.fail(getattr(e, "status_code", 500), getattr(e, "detail", str(e)))
+        raise
+    
+    start_background(run_job_in_background(
+        job, process_file_job(job, upload_path, vocabulary, start, end), "Error procesando archivo"
+    ))
+    return job_accepted(request, job)
 
-        # Guardar archivo subido
-        upload_path = os.path.join(job_dir, f"upload_{file.filename}")
-        content = await file.read()
-        
-        with open(upload_path, "wb") as f:
-            f.write(content)
 
-        # Convertir a WAV
-        wav_path = os.path.join(job_dir, AUDIO_FILENAME)
-        convert_to_wav(upload_path, wav_path)
+# ----------------------------
+# ENDPOINT /batches - Análisis por lotes (varios enlaces, playlist o varios archivos)
+# ----------------------------
+def batch_accepted(request: Request, batch: AnalysisBatch) -> dict:
+    return {
+        "batch_id": batch.batch_id,
+        "total": len(batch.jobs),
+        "skipped": batch.skipped,
+        "status_url": str(request.url_for("get_batch_status", batch_id=batch.batch_id)),
+        "jobs": [job_accepted(request, job) for job in batch.jobs]
+    }
 
-        # Analizar
-        result = analyze_audio_advanced(wav_path)
-        
-        # Leer archivo WAV para almacenarlo en BD
-        with open(wav_path, 'rb') as audio_file:
-            audio_data = audio_file.read()
 
-        # Obtener título del archivo
-        title = file.filename or "Archivo subido"
-        
-        # Guardar en historial
-        song_entry = SongHistory(
-            job_id=job_id,
-            user_id=user_id,
-            title=title,
-            source="file",
-            youtube_url=None,
-            tempo_bpm=result["tempo_bpm"],
-            key_detected=result["key"],
-            mode_detected=result["mode"],
-            chords_json=json.dumps(result["chords"]),
-            audio_data=audio_data
-        )
-        db.add(song_entry)
-        db.commit()
+@router.post("/batches", response_model=BatchResponse, status_code=202)
+async def create_link_batch(
+    req: BatchLinkRequest,
+    request: Request,
+    user: Principal = Depends(get_current_user)
+):
+    """Encola el análisis de una lista de enlaces o de los vídeos de una playlist"""
+    user_id = user.user_id
+    
+    videos = [(url, None) for url in req.urls]
+    if req.playlist_url:
+        videos += await asyncio.to_thread(expand_playlist, req.playlist_url, BATCH_MAX_ITEMS)
+    if not videos:
+        raise HTTPException(status_code=400, detail="Indica al menos un enlace o una playlist")
+    if len(videos) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Un lote admite como máximo {BATCH_MAX_ITEMS} enlaces")
+    
+    batch = create_batch(user_id, "playlist" if req.playlist_url else "youtube")
+    items = []
+    seen = set()
+    for url, title in videos:
+        # El mismo vídeo solo se analiza una vez por lote
+        key = link_cache_key(url, req.vocabulary) or url.strip()
+        if key in seen:
+            batch.skipped.append({"source": url, "reason": "Enlace repetido en el lote"})
+            continue
+        seen.add(key)
+        job = create_job(user_id, "youtube", title=title)
+        batch.jobs.append(job)
+        items.append((job, process_link_job(job, url, req.vocabulary), "Error procesando enlace"))
+    
+    start_background(run_batch(batch, items))
+    return batch_accepted(request, batch)
+
+
+@router.post("/batches/files", response_model=BatchResponse, status_code=202)
+async def create_file_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    vocabulary: Vocabulary = Form(DEFAULT_VOCABULARY),
+    user: Principal = Depends(get_current_user)
+):
+    """Guarda varios archivos y encola su análisis como un lote"""
+    user_id = user.user_id
+    
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Un lote admite como máximo {BATCH_MAX_FILES} archivos")
+    
+    batch = create_batch(user_id, "file")
+    items = []
+    for file in files:
+        job = create_job(user_id, "file", title=file.filename or "Archivo subido")
+        batch.jobs.append(job)
+        try:
+            # Los archivos deben guardarse antes de responder: UploadFile se cierra al terminar la petición
+            with job.timed("upload"):
+                upload_path = await save_upload(file, job.work_dir)
+        except Exception as e:
+            # Un archivo no válido no impide analizar el resto del lote
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+            job.fail(getattr(e, "status_code", 500), getattr(e, "detail", str(e)))
+            continue
+        items.append((job, process_file_job(job, upload_path, vocabulary), "Error procesando archivo"))
+    
+    start_background(run_batch(batch, items))
+    return batch_accepted(request, batch)
+
+
+@router.get("/batches/{batch_id}")
+async def get_batch_status(
+    batch_id: str,
+    user: Principal = Depends(get_current_user)
+):
+    """Progreso agregado del lote y estado de cada elemento"""
+    user_id = user.user_id
+    batch = get_batch(batch_id, user_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    return batch.to_dict()
 
-        return {
-            "job_id": job_id,
-            "analysis": result,
-            "title": title
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error procesando archivo: {str(e)}")
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(
+    job_id: str,
+    user: Principal = Depends(get_current_user)
+):
+    """Estado actual de un análisis (etapa, compases analizados y resultado final)"""
+    user_id = user.user_id
+    
+    job = get_job(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/events")
+async def get_job_events(
+    job_id: str,
+    user: Principal = Depends(get_current_user)
+):
+    """Stream SSE con los cambios de etapa y los acordes parciales del análisis"""
+    user_id = user.user_id
+    
+    job = get_job(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    
+    return StreamingResponse(
+        job.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 # ----------------------------
@@ -546,18 +608,16 @@ async def analyze_file(
 # ----------------------------
 @router.get("/history")
 async def get_history(
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
-    db: Session = Depends(get_db)
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    # Verificar token
-    token = credentials.credentials
-    payload = verify_token(token)
-    user_id = payload.get("user_id")
+    user_id = user.user_id
     
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
-    
-    songs = db.query(SongHistory).filter(SongHistory.user_id == user_id).order_by(SongHistory.analyzed_at.desc()).all()
+    songs = (await db.scalars(
+        select(SongHistory).options(undefer(SongHistory.chords_blob)).where(
+            SongHistory.user_id == user_id
+        ).order_by(SongHistory.analyzed_at.desc())
+    )).all()
     
     return [
         {
@@ -569,32 +629,122 @@ async def get_history(
             "key": song.key_detected,
             "mode": song.mode_detected,
             "analyzed_at": song.analyzed_at.isoformat() if song.analyzed_at else None,
-            "chords": song.chords_json if song.chords_json else []
+            # Este endpoint siempre ha devuelto los acordes como texto JSON
+            "chords": json.dumps(load_chords(song.chords_blob, song.chords_json))
         }
         for song in songs
     ]
 
 
+# ----------------------------
+# ENDPOINT /history/page - Historial paginado (solo resumen)
+# ----------------------------
+# Campos del resumen que se pueden pedir con ?fields= (nunca acordes ni audio)
+HISTORY_SUMMARY_FIELDS = {
+    "id": SongHistory.id,
+    "job_id": SongHistory.job_id,
+    "title": SongHistory.title,
+    "source": SongHistory.source,
+    "youtube_url": SongHistory.youtube_url,
+    "tempo_bpm": SongHistory.tempo_bpm,
+    "key": SongHistory.key_detected,
+    "mode": SongHistory.mode_detected,
+    "beats_per_bar": SongHistory.beats_per_bar,
+    "analyzed_at": SongHistory.analyzed_at,
+}
+
+
+def encode_history_cursor(analyzed_at: datetime, song_id: int) -> str:
+    raw = f"{analyzed_at.isoformat()}|{song_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor: str):
+    """Devuelve (analyzed_at, id) del último elemento de la página anterior"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        analyzed_at, song_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(analyzed_at), int(song_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+
+@router.get("/history/page", response_model=HistoryPage)
+async def get_history_page(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str = None,
+    fields: str = None,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Historial del usuario por páginas, del más reciente al más antiguo.
+
+    La página siguiente se pide con el next_cursor de la respuesta: el coste
+    de cada página no depende de cuántas canciones tenga el historial.
+    """
+    user_id = user.user_id
+    
+    selected = list(HISTORY_SUMMARY_FIELDS)
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in HISTORY_SUMMARY_FIELDS]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Campos no disponibles: {', '.join(unknown)}. Disponibles: {', '.join(HISTORY_SUMMARY_FIELDS)}"
+            )
+    
+    # id y analyzed_at se leen siempre: forman el cursor
+    columns = [HISTORY_SUMMARY_FIELDS[f].label(f) for f in selected]
+    query = select(
+        SongHistory.id.label("_id"),
+        SongHistory.analyzed_at.label("_analyzed_at"),
+        *columns
+    ).where(SongHistory.user_id == user_id)
+    
+    if cursor:
+        last_analyzed_at, last_id = decode_history_cursor(cursor)
+        query = query.where(or_(
+            SongHistory.analyzed_at < last_analyzed_at,
+            and_(SongHistory.analyzed_at == last_analyzed_at, SongHistory.id < last_id)
+        ))
+    
+    # Se pide un elemento de más para saber si hay página siguiente
+    rows = (await db.execute(
+        query.order_by(SongHistory.analyzed_at.desc(), SongHistory.id.desc()).limit(limit + 1)
+    )).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    items = []
+    for row in rows:
+        item = {f: getattr(row, f) for f in selected}
+        if item.get("analyzed_at"):
+            item["analyzed_at"] = item["analyzed_at"].isoformat()
+        items.append(item)
+    
+    next_cursor = None
+    if has_more and rows:
+        next_cursor = encode_history_cursor(rows[-1]._analyzed_at, rows[-1]._id)
+    
+    return {"items": items, "next_cursor": next_cursor}
+
+
 # ----------------------------
 # ENDPOINT /history/{song_id} - Detalle de canción
 # ----------------------------
 @router.get("/history/{song_id}")
 async def get_song_detail(
     song_id: int,
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
-    db: Session = Depends(get_db)
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    token = credentials.credentials
-    payload = verify_token(token)
-    user_id = payload.get("user_id")
+    user_id = user.user_id
     
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
-    
-    song = db.query(SongHistory).filter(
+    song = await db.scalar(select(SongHistory).options(undefer(SongHistory.chords_blob)).where(
         SongHistory.id == song_id,
         SongHistory.user_id == user_id
-    ).first()
+    ))
     
     if not song:
         raise HTTPException(status_code=404, detail="Canción no encontrada")
@@ -607,7 +757,7 @@ async def get_song_detail(
         "key": song.key_detected,
         "mode": song.mode_detected,
         "analyzed_at": song.analyzed_at.isoformat() if song.analyzed_at else None,
-        "chords": json.loads(song.chords_json) if song.chords_json else []
+        "chords": load_chords(song.chords_blob, song.chords_json)
     }
 
 
@@ -617,26 +767,26 @@ async def get_song_detail(
 @router.delete("/history/{song_id}")
 async def delete_song(
     song_id: int,
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
-    db: Session = Depends(get_db)
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    token = credentials.credentials
-    payload = verify_token(token)
-    user_id = payload.get("user_id")
-    
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
+    user_id = user.user_id
     
-    song = db.query(SongHistory).filter(
+    song = await db.scalar(select(SongHistory).where(
         SongHistory.id == song_id,
         SongHistory.user_id == user_id
-    ).first()
+    ))
     
     if not song:
         raise HTTPException(status_code=404, detail="Canción no encontrada")
     
-    db.delete(song)
-    db.commit()
+    audio_key = song.audio_key
+    await db.delete(song)
+    await db.commit()
+    
+    # El audio puede estar compartido con otros análisis de la misma canción
+    if audio_key:
+        await release_audio_async(db, audio_key)
     
     return {"message": "Canción eliminada del historial"}
 
@@ -645,34 +795,20 @@ async def delete_song(
 @router.get("/audio/{job_id}")
 async def get_analyzed_audio(
     job_id: str,
-    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
-    db: Session = Depends(get_db)
+    request: Request,
+    format: Literal["wav"] = None,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Devuelve el archivo WAV analizado para el job_id dado"""
+    """Devuelve el audio analizado para el job_id dado, por trozos y con soporte de Range"""
     print(f"🎵 Solicitando audio para job_id: {job_id}")
-    
-    # Verificar autenticación JWT
-    if not credentials:
-        print(f"❌ Sin token de autenticación para job_id: {job_id}")
-        raise HTTPException(status_code=401, detail="Token de autenticación requerido")
-    
-    token = credentials.credentials
-    try:
-        payload = verify_token(token)
-        user_id = payload.get("user_id")
-        print(f"✅ Usuario autenticado: {user_id} para job_id: {job_id}")
-    except Exception as e:
-        print(f"❌ Error verificando token: {e}")
-        raise HTTPException(status_code=401, detail="Token inválido")
-    
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
+    user_id = user.user_id
     
     # Verificar que el usuario tiene acceso a este job_id
-    song = db.query(SongHistory).filter(
+    song = await db.scalar(select(SongHistory).where(
         SongHistory.job_id == job_id,
         SongHistory.user_id == user_id
-    ).first()
+    ))
     
     if not song:
         print(f"❌ No hay acceso al job_id {job_id} para usuario {user_id}")
@@ -680,16 +816,47 @@ async def get_analyzed_audio(
     
     print(f"✅ Acceso confirmado para job_id: {job_id}, título: {song.title}")
     
-    # Verificar que el audio existe en la base de datos
-    if not song.audio_data:
+    # El audio está en el almacenamiento; las filas antiguas aún lo guardan en la BD (en WAV)
+    storage = get_storage()
+    codec = song.audio_codec or "wav"
+    if song.audio_key:
+        size = song.audio_size
+        if size is None:
+            size = await asyncio.to_thread(storage.size, song.audio_key)
+        open_stream = partial(storage.open, song.audio_key)
+        # La clave es el hash del contenido: sirve directamente como ETag
+        etag = f'"{song.audio_key}"'
+    else:
+        # audio_data es diferida: solo se lee (en una consulta aparte) para las filas antiguas
+        audio_data = await db.scalar(select(SongHistory.audio_data).where(SongHistory.id == song.id))
+        size = len(audio_data) if audio_data else None
+        if audio_data:
+            open_stream = bytes_opener(audio_data)
+            etag = f'"{hashlib.sha256(audio_data).hexdigest()}"'
+    
+    if size is None:
         print(f"❌ No hay datos de audio almacenados para job_id: {job_id}")
         raise HTTPException(status_code=404, detail=f"Archivo de audio no encontrado para el análisis: {job_id}")
     
-    print(f"✅ Sirviendo audio desde BD para job_id: {job_id}, tamaño: {len(song.audio_data)} bytes")
+    # Por defecto se envía el audio comprimido tal cual; ?format=wav lo convierte al vuelo
+    # por trozos (sin guardar copia ni cargarlo entero; la respuesta no admite Range)
+    if format == "wav" and codec != "wav":
+        print(f"✅ Sirviendo audio para job_id: {job_id} convertido a WAV al vuelo")
+        return streamed_audio_response(
+            request,
+            partial(iter_transcode_to_wav, partial(storage.open, song.audio_key), STREAM_CHUNK_BYTES),
+            etag=f'"{song.audio_key}.wav"',
+            media_type=AUDIO_CODECS["wav"]["media_type"],
+            filename=f"{job_id}.{AUDIO_CODECS['wav']['extension']}"
+        )
+    
+    print(f"✅ Sirviendo audio para job_id: {job_id}, códec: {codec}, tamaño: {size} bytes, rango: {request.headers.get('range', 'completo')}")
     
-    # Devolver el audio como respuesta binaria
-    return Response(
-        content=song.audio_data,
-        media_type="audio/wav",
-        headers={"Content-Disposition": f"inline; filename=\"{job_id}.wav\""}
+    return audio_response(
+        request,
+        open_stream,
+        size=size,
+        etag=etag,
+        media_type=AUDIO_CODECS[codec]["media_type"],
+        filename=f"{job_id}.{AUDIO_CODECS[codec]['extension']}"
     )
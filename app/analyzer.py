@@ -0,0 +1,537 @@
+import subprocess
+import time
+from functools import cached_property
+import librosa
+import numpy as np
+from scipy.signal import correlate
+from app.chords import DEFAULT_VOCABULARY
+from app.template_bank import load_template_bank
+
+# --- Constantes para análisis avanzado ---
+# Versión del algoritmo. Incrementarla al cambiar el análisis invalida la caché
+# de resultados (forma parte de la clave de caché).
+ANALYZER_VERSION = "4"
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Perfiles Krumhansl para detección de tonalidad
+KRUMHANSL_MAJOR = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
+KRUMHANSL_MINOR = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
+
+# Frecuencia de muestreo del análisis
+SAMPLE_RATE = 22050
+
+# Compases que se acumulan antes de notificar resultados parciales
+PARTIAL_BARS_BATCH = 8
+
+# Parámetros de la CQT (los valores por defecto de chroma_cqt)
+HOP_LENGTH = 512
+BINS_PER_OCTAVE = 36
+N_OCTAVES = 7
+# Octavas graves (desde C1) usadas para estimar la nota del bajo
+BASS_OCTAVES = 2
+# Ventana de la STFT (onsets y afinación) y resolución de la afinación (centésimas de bin)
+N_FFT = 2048
+TUNING_EDGES = np.linspace(-0.5, 0.5, 101)
+
+# Análisis por bloques: frames de cada bloque (~47 s) y de contexto a cada lado (~3 s,
+# más que medio filtro de la nota más grave de la CQT) para que el corte no se note
+BLOCK_FRAMES = 2048
+CONTEXT_FRAMES = 128
+# Ventana del tempograma para estimar el tempo (ac_size de librosa)
+TEMPO_WINDOW_SECONDS = 8.0
+
+# ---------------------------
+# 1. Detectar tonalidad usando perfiles Krumhansl
+# ---------------------------
+def detect_key_krumhansl(chroma_totals):
+    """Detecta la tonalidad usando perfiles Krumhansl-Schmuckler (a partir del croma sumado de la canción)"""
+    mean_chroma = chroma_totals / (chroma_totals.sum() + 1e-8)
+    
+    major_scores = []
+    minor_scores = []
+    for i in range(12):
+        major_scores.append(np.dot(np.roll(KRUMHANSL_MAJOR, i), mean_chroma))
+        minor_scores.append(np.dot(np.roll(KRUMHANSL_MINOR, i), mean_chroma))
+    
+    maj_best = int(np.argmax(major_scores))
+    min_best = int(np.argmax(minor_scores))
+    
+    if major_scores[maj_best] >= minor_scores[min_best]:
+        return NOTE_NAMES[maj_best], 'major', major_scores[maj_best]
+    else:
+        return NOTE_NAMES[min_best], 'minor', minor_scores[min_best]
+
+
+# -------------------------
+# Estimación del número de beats por compás
+# -------------------------
+def estimate_beats_per_bar(onset_env, beats_frames):
+    """Estima el número de beats por compás usando autocorrelación"""
+    if len(beats_frames) < 7:
+        return 4
+    
+    # Fuerza media de cada beat (de un beat al siguiente) con una sola reducción;
+    # reduceat devuelve onset_env[s] si el beat no tiene frames
+    sums = np.add.reduceat(onset_env, beats_frames)[:-1]
+    beat_strengths = sums / np.maximum(np.diff(beats_frames), 1)
+    
+    ac = correlate(beat_strengths - beat_strengths.mean(), 
+                   beat_strengths - beat_strengths.mean(), mode='full')
+    mid = len(ac)//2
+    ac_segment = ac[mid+1: mid+1+16]
+    
+    candidates = ac_segment[2:8] if len(ac_segment) >= 8 else ac_segment
+    if len(candidates) == 0:
+        return 4
+    
+    best = int(np.argmax(candidates)) + 3
+    return best
+
+
+# -------------------------
+# Recorrido del audio por bloques (memoria de trabajo acotada en canciones largas)
+# -------------------------
+def iter_blocks(y):
+    """Divide y en bloques de BLOCK_FRAMES frames con CONTEXT_FRAMES de contexto a cada lado.
+
+    Devuelve (primer frame del bloque, frames del bloque, frames de contexto a
+    la izquierda, muestras con contexto); las muestras son vistas de y, sin copias.
+    """
+    n_frames = 1 + len(y) // HOP_LENGTH
+    for first in range(0, n_frames, BLOCK_FRAMES):
+        count = min(BLOCK_FRAMES, n_frames - first)
+        context = min(first, CONTEXT_FRAMES)
+        segment = y[(first - context) * HOP_LENGTH:(first + count + CONTEXT_FRAMES) * HOP_LENGTH]
+        yield first, count, context, segment
+
+
+def ffmpeg_input_args(path: str, start: float = None, length: float = None) -> list:
+    """Argumentos de entrada de ffmpeg para leer path (o solo el fragmento desde start, de length segundos)"""
+    seek = ["-ss", f"{start:g}"] if start else []
+    limit = ["-t", f"{length:g}"] if length is not None else []
+    return [*seek, "-i", path, *limit]
+
+
+def pcm_decode_command(path: str, start: float = None, length: float = None) -> list:
+    """Comando de ffmpeg que escribe en stdout el audio en PCM float32 mono a SAMPLE_RATE"""
+    return [
+        "ffmpeg", "-v", "error",
+        *ffmpeg_input_args(path, start, length),
+        "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "pipe:1"
+    ]
+
+
+class PcmAudio:
+    """Audio ya decodificado en memoria (array PCM mono a SAMPLE_RATE)"""
+
+    def __init__(self, y):
+        self.y = y
+        self.n_samples = len(y)
+
+    def iter_blocks(self):
+        return iter_blocks(self.y)
+
+
+class AudioFileStream:
+    """Audio de un archivo que ffmpeg decodifica bloque a bloque en cada pasada.
+
+    El PCM completo no llega a existir: cada pasada (onsets y croma) vuelve a
+    lanzar ffmpeg y solo guarda el bloque en curso con su contexto, así que la
+    memoria no depende de la duración. Los bloques son los mismos que los de
+    iter_blocks sobre el PCM completo. Se envía al worker solo la ruta.
+    """
+
+    def __init__(self, path: str, start: float = None, length: float = None):
+        self.path = path
+        self.start = start
+        self.length = length
+        # La mide scan_audio en el proceso principal o la primera pasada en el worker
+        self.n_samples = None
+
+    @property
+    def input_args(self) -> list:
+        return ffmpeg_input_args(self.path, self.start, self.length)
+
+    def iter_blocks(self):
+        """Como iter_blocks(y), leyendo de ffmpeg solo las muestras de cada bloque"""
+        proc = subprocess.Popen(
+            pcm_decode_command(self.path, self.start, self.length),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        try:
+            buffer = np.zeros(0, dtype=np.float32)
+            buffer_start = 0  # muestra de la canción en la que empieza el buffer
+            n_samples = None  # se sabe al llegar al final de la salida de ffmpeg
+            first = 0
+            while True:
+                missing = (first + BLOCK_FRAMES + CONTEXT_FRAMES) * HOP_LENGTH - (buffer_start + len(buffer))
+                if n_samples is None and missing > 0:
+                    data = proc.stdout.read(missing * 4)
+                    samples = np.frombuffer(data, dtype=np.float32, count=len(data) // 4)
+                    buffer = np.concatenate([buffer, samples])
+                    if len(data) < missing * 4:
+                        n_samples = buffer_start + len(buffer)
+                count = BLOCK_FRAMES
+                if n_samples is not None:
+                    n_frames = 1 + n_samples // HOP_LENGTH
+                    if first >= n_frames:
+                        break
+                    count = min(BLOCK_FRAMES, n_frames - first)
+                context = min(first, CONTEXT_FRAMES)
+                yield first, count, context, buffer[
+                    (first - context) * HOP_LENGTH - buffer_start:(first + count + CONTEXT_FRAMES) * HOP_LENGTH - buffer_start
+                ]
+                # Del buffer solo se conserva el contexto izquierdo del bloque siguiente
+                first += BLOCK_FRAMES
+                keep = (first - CONTEXT_FRAMES) * HOP_LENGTH
+                buffer = buffer[keep - buffer_start:]
+                buffer_start = keep
+            stderr = proc.stderr.read()
+            if proc.wait() != 0:
+                raise RuntimeError(f"Error decodificando el audio: {stderr.decode(errors='replace')}")
+            self.n_samples = n_samples
+        finally:
+            # Pasada interrumpida (error en el análisis): no dejar ffmpeg vivo
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+
+def tuning_histogram(pitches, mags):
+    """Histograma de desviaciones de afinación de un bloque (el de librosa.estimate_tuning)"""
+    pitch_mask = pitches > 0
+    if not pitch_mask.any():
+        return np.zeros(len(TUNING_EDGES) - 1, dtype=np.int64)
+    threshold = np.median(mags[pitch_mask])
+    frequencies = pitches[(mags >= threshold) & pitch_mask]
+    residual = np.mod(BINS_PER_OCTAVE * librosa.hz_to_octs(frequencies), 1.0)
+    residual[residual >= 0.5] -= 1.0
+    return np.histogram(residual, TUNING_EDGES)[0]
+
+
+def onset_and_tuning(audio, sr):
+    """Primera pasada: envolvente de onsets y afinación, con una sola STFT por bloque.
+
+    Devuelve la envolvente de onsets (la de beat_track, agregada con la mediana)
+    y la desviación de afinación en bins.
+    """
+    onset_env = []
+    tuning_counts = np.zeros(len(TUNING_EDGES) - 1, dtype=np.int64)
+    for _, count, context, segment in audio.iter_blocks():
+        core = slice(context, context + count)
+        S = np.abs(librosa.stft(segment, n_fft=N_FFT, hop_length=HOP_LENGTH))
+        mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S ** 2, sr=sr, fmax=0.5 * sr))
+        onset_env.append(librosa.onset.onset_strength(
+            S=mel_db, sr=sr, n_fft=N_FFT, hop_length=HOP_LENGTH, aggregate=np.median
+        )[core])
+        tuning_counts += tuning_histogram(*librosa.piptrack(S=S[:, core], sr=sr))
+    
+    tuning = float(TUNING_EDGES[np.argmax(tuning_counts)]) if tuning_counts.any() else 0.0
+    return np.concatenate(onset_env), tuning
+
+
+def estimate_tempo(onset_env, sr):
+    """Tempo global como el de beat_track, con el tempograma medio acumulado por bloques
+    (el tempograma completo ocupa cientos de MB en una canción larga)"""
+    win_length = librosa.time_to_frames(TEMPO_WINDOW_SECONDS, sr=sr, hop_length=HOP_LENGTH).item()
+    half = win_length // 2
+    totals = np.zeros(win_length)
+    for first in range(0, len(onset_env), BLOCK_FRAMES):
+        count = min(BLOCK_FRAMES, len(onset_env) - first)
+        context = min(first, half)
+        tg = librosa.feature.tempogram(
+            onset_envelope=onset_env[first - context:first + count + half],
+            sr=sr, hop_length=HOP_LENGTH, win_length=win_length
+        )
+        totals += tg[:, context:context + count].sum(axis=1)
+    return librosa.feature.tempo(tg=(totals / max(len(onset_env), 1))[:, None], sr=sr, hop_length=HOP_LENGTH)
+
+
+# -------------------------
+# Extracción de características (una sola CQT por bloque)
+# -------------------------
+def extract_features(y, sr, tuning: float, frames: slice = slice(None)):
+    """Calcula la CQT una vez y deriva de ella el croma completo y el croma del bajo
+    (solo de los frames indicados; el resto es contexto)"""
+    C = np.abs(librosa.cqt(
+        y=y,
+        sr=sr,
+        hop_length=HOP_LENGTH,
+        n_bins=N_OCTAVES * BINS_PER_OCTAVE,
+        bins_per_octave=BINS_PER_OCTAVE,
+        tuning=tuning
+    ))[:, frames]
+    
+    # Croma de todo el registro (tonalidad y acordes)
+    chroma = librosa.feature.chroma_cqt(C=C, sr=sr, hop_length=HOP_LENGTH, bins_per_octave=BINS_PER_OCTAVE)
+    # Croma de las dos octavas graves: la misma CQT recortada (equivale a chroma_cqt con n_octaves=2)
+    bass_chroma = librosa.feature.chroma_cqt(
+        C=C[:BASS_OCTAVES * BINS_PER_OCTAVE], sr=sr, hop_length=HOP_LENGTH, bins_per_octave=BINS_PER_OCTAVE
+    )
+    return chroma, bass_chroma
+
+
+# -------------------------
+# Características de un análisis (cada una se calcula una sola vez y solo si se usa)
+# -------------------------
+class AnalysisFeatures:
+    """Características de una canción compartidas por las etapas del análisis.
+
+    Cada propiedad se calcula la primera vez que una etapa la lee. La STFT y
+    la CQT no se guardan completas: se recorren por bloques (la envolvente de
+    onsets y la afinación salen de la misma STFT de cada bloque). audio es un
+    PcmAudio o un AudioFileStream.
+    """
+
+    def __init__(self, audio, sr: int = SAMPLE_RATE):
+        self.audio = audio
+        self.sr = sr
+
+    @cached_property
+    def _onsets_and_tuning(self):
+        return onset_and_tuning(self.audio, self.sr)
+
+    @property
+    def onset_envelope(self):
+        return self._onsets_and_tuning[0]
+
+    @property
+    def tuning(self) -> float:
+        return self._onsets_and_tuning[1]
+
+    @cached_property
+    def tempo(self) -> float:
+        # Sin onsets no hay tempo (como en beat_track)
+        if not self.onset_envelope.any():
+            return 0.0
+        return float(estimate_tempo(self.onset_envelope, self.sr)[0])
+
+    @cached_property
+    def beat_frames(self):
+        _, beat_frames = librosa.beat.beat_track(
+            onset_envelope=self.onset_envelope, sr=self.sr, hop_length=HOP_LENGTH, bpm=self.tempo
+        )
+        return beat_frames
+
+    @cached_property
+    def beat_times(self):
+        return librosa.frames_to_time(self.beat_frames, sr=self.sr, hop_length=HOP_LENGTH)
+
+    @cached_property
+    def beats_per_bar(self) -> int:
+        beats_per_bar = estimate_beats_per_bar(self.onset_envelope, self.beat_frames)
+        return beats_per_bar if beats_per_bar in [3, 4] else 4
+
+    @property
+    def duration(self) -> float:
+        # En un AudioFileStream, n_samples se conoce tras la primera pasada
+        self._onsets_and_tuning
+        return self.audio.n_samples / self.sr
+
+    @property
+    def n_frames(self) -> int:
+        self._onsets_and_tuning
+        return 1 + self.audio.n_samples // HOP_LENGTH
+
+    def iter_chroma(self):
+        """Croma y croma del bajo bloque a bloque: (primer frame, croma, croma del bajo)"""
+        for first, count, context, segment in self.audio.iter_blocks():
+            chroma, bass_chroma = extract_features(segment, self.sr, self.tuning, slice(context, context + count))
+            yield first, chroma, bass_chroma
+
+
+# -------------------------
+# Medias de croma por compás
+# -------------------------
+def segment_means(features, starts, ends):
+    """Media de cada fila de features (d, frames) en los intervalos [starts, ends) de frames"""
+    cumulative = np.zeros((features.shape[0], features.shape[1] + 1))
+    np.cumsum(features, axis=1, out=cumulative[:, 1:])
+    lengths = np.maximum(ends - starts, 1)
+    return ((cumulative[:, ends] - cumulative[:, starts]) / lengths).T
+
+
+# -------------------------
+# Detectar acordes de todos los compases a la vez
+# -------------------------
+def detect_chords_in_bars(chroma, bass_chroma, start_frames, end_frames, templates):
+    """Puntúa todos los compases contra todas las plantillas con un solo producto matricial.
+
+    El bajo dominante de cada compás (croma grave) multiplica por 1.15 la
+    puntuación de los acordes con esa fundamental. Devuelve un acorde por compás
+    ("N.C." si el compás no tiene frames válidos o es silencio).
+    """
+    n_frames = chroma.shape[1]
+    valid = (end_frames > start_frames) & (end_frames <= n_frames)
+    starts = np.where(valid, start_frames, 0)
+    ends = np.where(valid, end_frames, 0)
+    
+    # Croma medio normalizado por compás: (n_compases, 12)
+    bar_chroma = segment_means(chroma, starts, ends)
+    norms = np.linalg.norm(bar_chroma, axis=1)
+    valid &= norms >= 1e-6
+    bar_chroma = bar_chroma / np.maximum(norms, 1e-6)[:, None]
+    
+    scores = bar_chroma @ templates.matrix.T
+    
+    # Bonificación por bajo (menos de 2 frames no da una estimación fiable)
+    bass_notes = np.argmax(segment_means(bass_chroma, starts, ends), axis=1)
+    has_bass = valid & (ends - starts >= 2)
+    bass_match = (templates.roots[None, :] == bass_notes[:, None]) & has_bass[:, None]
+    scores = np.where(bass_match, scores * 1.15, scores)
+    
+    best = np.argmax(scores, axis=1)
+    return np.where(valid, templates.labels[best], "N.C.").tolist()
+
+
+# -------------------------
+# Análisis principal de audio
+# -------------------------
+def _lap(timings, stage: str, started: float) -> float:
+    """Anota en timings la duración de la etapa y devuelve el instante actual"""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = now - started
+    return now
+
+
+def bar_boundaries(beat_times, beats_per_bar: int, duration: float):
+    """Inicio y fin (segundos) de cada compás: desde su primer beat hasta el primer beat del siguiente"""
+    num_beats = len(beat_times)
+    bar_start_beats = np.arange(0, num_beats, beats_per_bar)
+    next_bar_beats = bar_start_beats + beats_per_bar
+    start_times = beat_times[bar_start_beats]
+    end_times = np.where(
+        next_bar_beats < num_beats,
+        beat_times[np.minimum(next_bar_beats, num_beats - 1)],
+        duration
+    )
+    return start_times, end_times
+
+
+def analyze_audio_advanced(audio, vocabulary: str = DEFAULT_VOCABULARY, on_bars=None, timings: dict = None):
+    """Análisis avanzado de audio con detección de acordes por compás.
+
+    audio puede ser un array PCM mono a SAMPLE_RATE, la ruta de un archivo o un
+    AudioFileStream (el fragmento de un archivo, como lo recibe el worker del
+    pipeline); los archivos los decodifica ffmpeg bloque a bloque.
+
+    El audio se recorre en bloques solapados (iter_blocks): una primera pasada
+    obtiene onsets y afinación para los beats y el compás, y una segunda calcula
+    el croma y detecta los compases en cuanto su croma está completo. Con un
+    archivo la memoria no depende de la duración de la canción: ni el PCM ni la
+    STFT, el tempograma o el croma se guardan completos (solo la envolvente de
+    onsets y los compases, unos KB por minuto).
+
+    vocabulary elige el conjunto de acordes candidatos ("basic" o "extended",
+    ver app/chords.py). Si se indica on_bars, se llama con cada lote de compases ya detectados
+    (sin prevChord/nextChord) para poder mostrar resultados parciales.
+
+    Si se pasa un dict en timings, se rellena con la duración en segundos de
+    cada etapa (beat_tracking, meter, chroma, bar_detection, key).
+    """
+    started = time.perf_counter()
+    if isinstance(audio, np.ndarray):
+        audio = PcmAudio(audio)
+    elif isinstance(audio, str):
+        audio = AudioFileStream(audio)
+    sr = SAMPLE_RATE
+    features = AnalysisFeatures(audio, sr)
+    
+    # Tempo y beats (primera pasada)
+    beat_times = features.beat_times
+    started = _lap(timings, "beat_tracking", started)
+    
+    # Estimar beats por compás (con la misma envolvente de onsets)
+    beats_per_bar = features.beats_per_bar
+    started = _lap(timings, "meter", started)
+    
+    # Plantillas del vocabulario (compiladas y mapeadas en memoria una vez por proceso)
+    templates = load_template_bank(vocabulary)
+    
+    start_times, end_times = bar_boundaries(beat_times, beats_per_bar, features.duration)
+    start_frames = librosa.time_to_frames(start_times, sr=sr, hop_length=HOP_LENGTH)
+    end_frames = librosa.time_to_frames(end_times, sr=sr, hop_length=HOP_LENGTH)
+    num_bars = len(start_frames)
+    
+    # Segunda pasada: croma por bloques. Solo se conserva el croma desde el
+    # primer compás pendiente; para la tonalidad basta con su suma.
+    chroma_totals = np.zeros(12)
+    chroma_buffer = np.zeros((12, 0), dtype=np.float32)
+    bass_buffer = np.zeros((12, 0), dtype=np.float32)
+    buffer_first = 0
+    next_bar = 0
+    chroma_seconds = detection_seconds = 0.0
+    chords_result = []
+    n_frames = features.n_frames
+    for first, chroma, bass_chroma in features.iter_chroma():
+        count = chroma.shape[1]
+        chroma_totals += chroma.sum(axis=1)
+        chroma_buffer = np.concatenate([chroma_buffer, chroma], axis=1)
+        bass_buffer = np.concatenate([bass_buffer, bass_chroma], axis=1)
+        block_started = time.perf_counter()
+        chroma_seconds += block_started - started
+        
+        # Compases cuyo croma ya está completo
+        ready = num_bars if first + count >= n_frames else int(np.searchsorted(end_frames, first + count, side="right"))
+        if ready > next_bar:
+            bars = slice(next_bar, ready)
+            chords = detect_chords_in_bars(
+                chroma_buffer, bass_buffer,
+                start_frames[bars] - buffer_first, end_frames[bars] - buffer_first, templates
+            )
+            new_bars = [
+                {
+                    "start_time": round(float(start_time), 2),
+                    "end_time": round(float(end_time), 2),
+                    "chord": chord,
+                    "bar": next_bar + offset + 1
+                }
+                for offset, (start_time, end_time, chord) in enumerate(zip(start_times[bars], end_times[bars], chords))
+            ]
+            chords_result.extend(new_bars)
+            next_bar = ready
+            if on_bars:
+                for batch_start in range(0, len(new_bars), PARTIAL_BARS_BATCH):
+                    on_bars([dict(c) for c in new_bars[batch_start:batch_start + PARTIAL_BARS_BATCH]])
+        
+        # Descartar el croma que ya no necesita ningún compás
+        keep_from = start_frames[next_bar] if next_bar < num_bars else first + count
+        if keep_from > buffer_first:
+            chroma_buffer = chroma_buffer[:, keep_from - buffer_first:]
+            bass_buffer = bass_buffer[:, keep_from - buffer_first:]
+            buffer_first = keep_from
+        started = time.perf_counter()
+        detection_seconds += started - block_started
+    
+    if timings is not None:
+        timings["chroma"] = chroma_seconds
+        timings["bar_detection"] = detection_seconds
+    
+    # Tonalidad
+    key_root, key_mode, key_confidence = detect_key_krumhansl(chroma_totals)
+    _lap(timings, "key", started)
+    
+    # Agregar prevChord y nextChord
+    for idx, c in enumerate(chords_result):
+        c["prevChord"] = chords_result[idx - 1]["chord"] if idx > 0 else None
+        c["nextChord"] = chords_result[idx + 1]["chord"] if idx < len(chords_result) - 1 else None
+    
+    return {
+        "tempo_bpm": round(features.tempo, 1),
+        "key": key_root,
+        "mode": key_mode,
+        "beats_per_bar": beats_per_bar,
+        "chords": chords_result
+    }
+
+
+def analyze_with_timings(audio, vocabulary: str = DEFAULT_VOCABULARY, on_bars=None):
+    """Como analyze_audio_advanced, pero devuelve (resultado, duración de cada etapa)"""
+    timings = {}
+    result = analyze_audio_advanced(audio, vocabulary, on_bars, timings)
+    return result, timings
@@ -0,0 +1,57 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from app.config import ASYNC_DATABASE_URL, DATABASE_URL
+from app.database import engine_options, configure_connection, pool_connections
+from app.metrics import Gauge
+
+# Driver asíncrono de cada motor (los scripts siguen usando el motor síncrono de app/database.py)
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+    "sqlite": "aiosqlite",
+}
+
+
+def async_database_url(database_url: str):
+    """La misma URL de DATABASE_URL con el driver asíncrono de su motor"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No hay driver asíncrono para la base de datos {backend}")
+    url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    # asyncpg no entiende sslmode (psycopg2/libpq): su equivalente es ssl
+    if backend == "postgresql" and "sslmode" in url.query:
+        url = url.difference_update_query(["sslmode"]).update_query_dict({"ssl": url.query["sslmode"]})
+    return url
+
+
+# Crear el motor asíncrono (mismo perfil de pool que el síncrono)
+_async_url = make_url(ASYNC_DATABASE_URL) if ASYNC_DATABASE_URL else async_database_url(DATABASE_URL)
+_async_engine_options = engine_options(_async_url, asynchronous=True)
+async_engine = create_async_engine(_async_url, **_async_engine_options)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    configure_connection(dbapi_connection, async_engine.url.get_backend_name())
+
+Gauge(
+    "chordmaster_db_async_pool_connections",
+    "Conexiones del pool asíncrono de la base de datos por estado",
+    lambda: pool_connections(async_engine.sync_engine.pool),
+    labelnames=("state",)
+)
+Gauge(
+    "chordmaster_db_async_pool_capacity",
+    "Conexiones máximas del pool asíncrono (pool_size + max_overflow)",
+    lambda: _async_engine_options.get("pool_size", 0) + _async_engine_options.get("max_overflow", 0)
+)
+
+# expire_on_commit=False: tras el commit los objetos se siguen leyendo sin volver a la BD
+# (en una sesión asíncrona no se puede cargar un atributo de forma implícita)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
+# Función para obtener la sesión asíncrona de la base de datos
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
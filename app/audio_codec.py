@@ -0,0 +1,132 @@
+import io
+import subprocess
+import threading
+import numpy as np
+import soundfile as sf
+from app.analyzer import AudioFileStream, SAMPLE_RATE
+from app.config import AUDIO_OPUS_BITRATE
+
+# Códecs del audio guardado: argumentos de ffmpeg, tipo MIME y extensión
+AUDIO_CODECS = {
+    "wav": {
+        "args": ["-c:a", "pcm_s16le", "-f", "wav"],
+        "media_type": "audio/wav",
+        "extension": "wav",
+    },
+    "flac": {
+        "args": ["-c:a", "flac", "-compression_level", "8", "-f", "flac"],
+        "media_type": "audio/flac",
+        "extension": "flac",
+    },
+    "opus": {
+        "args": ["-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE, "-application", "audio", "-f", "ogg"],
+        "media_type": "audio/ogg",
+        "extension": "ogg",
+    },
+}
+
+
+def run_ffmpeg(args: list, data) -> bytes:
+    """Ejecuta ffmpeg leyendo de stdin y escribiendo en stdout, todo en memoria"""
+    cmd = ["ffmpeg", "-v", "error", *args]
+    result = subprocess.run(cmd, input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error de ffmpeg: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+
+def encode_wav(pcm: np.ndarray) -> bytes:
+    """Codifica el PCM como WAV de 16 bits en memoria"""
+    buffer = io.BytesIO()
+    sf.write(buffer, pcm, SAMPLE_RATE, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def encode_audio(pcm: np.ndarray, codec: str) -> bytes:
+    """Codifica el PCM float32 mono con el códec indicado para guardarlo"""
+    if codec == "wav":
+        return encode_wav(pcm)
+    args = [
+        "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "pipe:0",
+        *AUDIO_CODECS[codec]["args"],
+        # Salida reproducible: el mismo audio da los mismos bytes (y la misma clave)
+        "-fflags", "+bitexact", "-flags:a", "+bitexact",
+        "pipe:1"
+    ]
+    # Vista en bytes: subprocess avanza por bytes escritos, no por elementos
+    return run_ffmpeg(args, memoryview(np.ascontiguousarray(pcm, dtype=np.float32)).cast("B"))
+
+
+def encode_audio_file(audio: AudioFileStream, codec: str, output_path: str):
+    """Codifica el audio (o el fragmento) de un archivo con el códec indicado, de disco a disco.
+
+    ffmpeg lee directamente el archivo original: el PCM no pasa por memoria.
+    Se remuestrea a SAMPLE_RATE mono como el audio analizado.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error",
+        *audio.input_args,
+        "-ac", "1", "-af", f"aresample={SAMPLE_RATE}",
+        *AUDIO_CODECS[codec]["args"],
+        "-fflags", "+bitexact", "-flags:a", "+bitexact",
+        "-y", output_path
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error de ffmpeg: {result.stderr.decode(errors='replace').strip()}")
+
+
+def decode_audio_bytes(data: bytes) -> np.ndarray:
+    """Decodifica audio guardado (cualquier códec) a PCM float32 mono a SAMPLE_RATE"""
+    pcm = run_ffmpeg(["-i", "pipe:0", "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"], data)
+    return np.frombuffer(pcm, dtype=np.float32)
+
+
+def iter_transcode_to_wav(open_stream, chunk_bytes: int):
+    """WAV reproducible en cualquier navegador a partir del audio comprimido, por trozos.
+
+    ffmpeg lee el audio guardado por stdin (un hilo lo copia desde open_stream()
+    por bloques) y cada trozo de stdout se entrega en cuanto sale: no se guarda
+    ninguna copia y la memoria no depende de la duración. El tamaño final no se
+    conoce, así que la cabecera lleva el tamaño de WAV en streaming (0xFFFFFFFF).
+    Se itera en el threadpool de Starlette; si el cliente corta, ffmpeg se detiene.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", "pipe:0",
+        "-ac", "1", "-ar", str(SAMPLE_RATE), "-c:a", "pcm_s16le",
+        "-fflags", "+bitexact", "-f", "wav", "pipe:1"
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        source = open_stream()
+        try:
+            while True:
+                chunk = source.read(chunk_bytes)
+                if not chunk:
+                    break
+                proc.stdin.write(chunk)
+        except OSError:
+            # ffmpeg terminó (o se detuvo porque el cliente cortó)
+            pass
+        finally:
+            source.close()
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        feeder.join()
+        proc.stdout.close()
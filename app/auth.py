@@ -1,9 +1,20 @@
+import asyncio
 import bcrypt
+import jwt
 import secrets
-from jose import JWTError, jwt
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from datetime import datetime, timedelta, timezone
-from typing import Optional
-from app.config import JWT_SECRET_KEY
+from typing import NamedTuple, Optional
+from app.ttl_cache import TTLCache
+from app.config import (
+    JWT_SECRET_KEY, BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_TIMEOUT_SECONDS,
+    AUTH_TOKEN_CACHE_MAX_ENTRIES
+)
+from app.database import utc_now
+from app.metrics import Gauge
 
 # Configuración JWT
 SECRET_KEY = JWT_SECRET_KEY
@@ -11,9 +22,12 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 5
 
+# Segundos sugeridos en Retry-After cuando no hay hilos de bcrypt libres
+PASSWORD_HASH_RETRY_AFTER = 5
+
 def hash_password(password: str) -> str:
     """Hashea una contraseña usando bcrypt"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -21,6 +35,53 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifica una contraseña contra su hash"""
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True si el hash se generó con un coste distinto de BCRYPT_ROUNDS ($2b$<coste>$...)"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+# ----------------------------
+# bcrypt fuera del event loop
+# ----------------------------
+# Cada hash ocupa ~250 ms de CPU: en el event loop bloquearía todas las peticiones.
+# bcrypt libera el GIL, así que un pool de hilos propio reparte los hashes entre núcleos.
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+# Peticiones esperando un hilo libre
+_hash_waiting = 0
+
+Gauge("chordmaster_password_hash_waiting", "Peticiones esperando un hilo de bcrypt", lambda: _hash_waiting)
+
+async def run_password_hash(func, *args):
+    """Ejecuta func(*args) en el pool de bcrypt, o responde 503 si no queda
+    un hilo libre en PASSWORD_HASH_TIMEOUT_SECONDS"""
+    global _hash_waiting
+    _hash_waiting += 1
+    try:
+        await asyncio.wait_for(_hash_slots.acquire(), PASSWORD_HASH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiados inicios de sesión a la vez. Inténtalo de nuevo en unos segundos.",
+            headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)}
+        )
+    finally:
+        _hash_waiting -= 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        _hash_slots.release()
+
+async def hash_password_async(password: str) -> str:
+    """hash_password en el pool de bcrypt"""
+    return await run_password_hash(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password en el pool de bcrypt"""
+    return await run_password_hash(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crea un token JWT de acceso"""
     to_encode = data.copy()
@@ -37,17 +98,55 @@ def create_refresh_token() -> str:
     return secrets.token_urlsafe(64)
 
 def get_refresh_token_expiry() -> datetime:
-    """Obtiene la fecha de expiración para un refresh token"""
-    return datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    """Obtiene la fecha de expiración para un refresh token (UTC sin zona horaria, como se guarda en la BD)"""
+    return utc_now() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+# ----------------------------
+# Verificación de tokens de acceso
+# ----------------------------
+class Principal(NamedTuple):
+    """Usuario autenticado por un token de acceso"""
+    user_id: int
+    email: str
+
 
-def verify_token(token: str):
-    """Verifica un token JWT de acceso"""
+# Tokens ya verificados -> Principal, hasta su exp: las peticiones repetidas
+# (sondeo de jobs, historial, audio) no vuelven a decodificar ni a comprobar la firma
+_verified_tokens = TTLCache(AUTH_TOKEN_CACHE_MAX_ENTRIES, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+_bearer = HTTPBearer(auto_error=False)
+
+def verify_token(token: str) -> Principal:
+    """Verifica un token JWT de acceso y devuelve su usuario (401 si no es válido)"""
+    principal = _verified_tokens.get(token)
+    if principal is not None:
+        return principal
+    
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        token_type: str = payload.get("type")
-        if email is None or token_type != "access":
-            return None
-        return email
-    except JWTError:
-        return None
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp"]})
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expirado. Por favor, inicia sesión de nuevo.")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Token inválido. No autorizado.")
+    
+    if payload.get("type") != "access":
+        raise HTTPException(status_code=401, detail="Token inválido. No autorizado.")
+    if not payload.get("user_id"):
+        raise HTTPException(status_code=401, detail="Token inválido: user_id no encontrado")
+    
+    principal = Principal(user_id=payload["user_id"], email=payload.get("sub"))
+    _verified_tokens.put(token, principal, ttl_seconds=payload["exp"] - time.time())
+    return principal
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(_bearer)) -> Principal:
+    """Dependencia de FastAPI: usuario del token Bearer de la petición.
+
+    Es async (no bloquea: caché en memoria o un HMAC) para no pasar por el threadpool en cada petición.
+    """
+    if not credentials:
+        raise HTTPException(
+            status_code=401,
+            detail="Token de autenticación requerido",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return verify_token(credentials.credentials)
@@ -1,26 +1,33 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 from sqlalchemy.exc import OperationalError
-from app.database import get_db, User, RefreshToken, create_tables
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.async_database import get_async_db
+from app.database import User, create_tables, utc_now
 from app.schemas import UserRegister, UserLogin, Token, UserRegisterResponse, TokenRefresh, AccessTokenResponse
-from app.auth import hash_password, verify_password, create_access_token, create_refresh_token, get_refresh_token_expiry
-from datetime import timedelta, datetime, timezone
+from app.auth import (
+    hash_password_async, verify_password_async, password_needs_rehash, create_access_token
+)
+from app.refresh_tokens import (
+    issue_refresh_token, find_active_refresh_token, revoke_refresh_token, revoke_user_refresh_tokens
+)
+from datetime import timedelta
 
 router = APIRouter()
 
 @router.post("/register", response_model=UserRegisterResponse)
-async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register_user(user_data: UserRegister, db: AsyncSession = Depends(get_async_db)):
     try:
         # Verificar si el email ya existe
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == user_data.email))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="El email ya está registrado"
             )
         
-        # Hashear la contraseña
-        hashed_password = hash_password(user_data.password)
+        # Hashear la contraseña (en el pool de bcrypt, fuera del event loop)
+        hashed_password = await hash_password_async(user_data.password)
         
         # Crear el nuevo usuario
         new_user = User(
@@ -31,8 +38,8 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
         
         # Guardar en la base de datos
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         
         # Crear el token de acceso para el nuevo usuario
         access_token_expires = timedelta(minutes=30)
@@ -40,18 +47,9 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
             data={"sub": new_user.email, "user_id": new_user.id}, expires_delta=access_token_expires
         )
         
-        # Crear el refresh token
-        refresh_token = create_refresh_token()
-        refresh_token_expires = get_refresh_token_expiry()
-        
-        # Guardar el refresh token en la base de datos
-        db_refresh_token = RefreshToken(
-            token=refresh_token,
-            user_id=new_user.id,
-            expires_at=refresh_token_expires
-        )
-        db.add(db_refresh_token)
-        db.commit()
+        # Crear el refresh token (en la base de datos solo se guarda su hash)
+        refresh_token = issue_refresh_token(db, new_user.id)
+        await db.commit()
         
         # Devolver el usuario con ambos tokens        
         return {
@@ -64,8 +62,10 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
             "token_type": "bearer"
         }
         
+    except HTTPException:
+        raise
     except OperationalError as e:
-        db.rollback()
+        await db.rollback()
         if "is full" in str(e):
             raise HTTPException(
                 status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
@@ -76,52 +76,44 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
             detail="Error en la base de datos: " + str(e)
         )
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error interno del servidor: " + str(e)
         )
 
 @router.post("/login", response_model=Token)
-async def login_user(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login_user(user_credentials: UserLogin, db: AsyncSession = Depends(get_async_db)):
     """
     Autentica un usuario y devuelve un token JWT
     """
     try:
         # Buscar el usuario por email
-        user = db.query(User).filter(User.email == user_credentials.email).first()
+        user = await db.scalar(select(User).where(User.email == user_credentials.email))
         
-        if not user or not verify_password(user_credentials.password, user.password):
+        if not user or not await verify_password_async(user_credentials.password, user.password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Email o contraseña incorrectos",
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
+        # Si cambió BCRYPT_ROUNDS, rehacer el hash (se guarda junto al nuevo refresh token)
+        if password_needs_rehash(user.password):
+            user.password = await hash_password_async(user_credentials.password)
+        
         # Crear el token de acceso
         access_token_expires = timedelta(minutes=30)
         access_token = create_access_token(
             data={"sub": user.email, "user_id": user.id}, expires_delta=access_token_expires
         )
         
-        # Crear el refresh token
-        refresh_token = create_refresh_token()
-        refresh_token_expires = get_refresh_token_expiry()
-        
         # Invalidar tokens de refresh anteriores del usuario
-        db.query(RefreshToken).filter(
-            RefreshToken.user_id == user.id,
-            RefreshToken.is_active == "true"
-        ).update({"is_active": "false"})
+        await revoke_user_refresh_tokens(db, user.id)
         
-        # Guardar el nuevo refresh token en la base de datos
-        db_refresh_token = RefreshToken(
-            token=refresh_token,
-            user_id=user.id,
-            expires_at=refresh_token_expires
-        )
-        db.add(db_refresh_token)
-        db.commit()
+        # Crear el nuevo refresh token (en la base de datos solo se guarda su hash)
+        refresh_token = issue_refresh_token(db, user.id)
+        await db.commit()
         
         return {
             "access_token": access_token, 
@@ -140,16 +132,13 @@ async def login_user(user_credentials: UserLogin, db: Session = Depends(get_db))
         )
 
 @router.post("/refresh", response_model=AccessTokenResponse)
-async def refresh_access_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
+async def refresh_access_token(token_data: TokenRefresh, db: AsyncSession = Depends(get_async_db)):
     """
     Renueva un access token usando un refresh token válido
     """
     try:
         # Buscar el refresh token en la base de datos
-        refresh_token_record = db.query(RefreshToken).filter(
-            RefreshToken.token == token_data.refresh_token,
-            RefreshToken.is_active == "true"
-        ).first()
+        refresh_token_record = await find_active_refresh_token(db, token_data.refresh_token)
         
         if not refresh_token_record:
             raise HTTPException(
@@ -157,18 +146,15 @@ async def refresh_access_token(token_data: TokenRefresh, db: Session = Depends(g
                 detail="Refresh token inválido o expirado"
             )
         
-        # Verificar si el token ha expirado
-        if refresh_token_record.expires_at < datetime.now(timezone.utc):
-            # Marcar el token como inactivo
-            refresh_token_record.is_active = "false"
-            db.commit()
+        # Verificar si el token ha expirado (el barrido periódico lo borrará)
+        if refresh_token_record.expires_at < utc_now():
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Refresh token expirado"
             )
         
         # Obtener el usuario asociado
-        user = db.query(User).filter(User.id == refresh_token_record.user_id).first()
+        user = await db.get(User, refresh_token_record.user_id)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -195,20 +181,17 @@ async def refresh_access_token(token_data: TokenRefresh, db: Session = Depends(g
         )
 
 @router.post("/logout")
-async def logout_user(token_data: TokenRefresh, db: Session = Depends(get_db)):
+async def logout_user(token_data: TokenRefresh, db: AsyncSession = Depends(get_async_db)):
     """
     Cierra sesión invalidando el refresh token
     """
     try:
         # Buscar y desactivar el refresh token
-        refresh_token_record = db.query(RefreshToken).filter(
-            RefreshToken.token == token_data.refresh_token,
-            RefreshToken.is_active == "true"
-        ).first()
+        refresh_token_record = await find_active_refresh_token(db, token_data.refresh_token)
         
         if refresh_token_record:
-            refresh_token_record.is_active = "false"
-            db.commit()
+            revoke_refresh_token(refresh_token_record)
+            await db.commit()
         
         return {"message": "Logout exitoso"}
         
@@ -219,16 +202,13 @@ async def logout_user(token_data: TokenRefresh, db: Session = Depends(get_db)):
         )
 
 @router.post("/logout-all")
-async def logout_all_devices(token_data: TokenRefresh, db: Session = Depends(get_db)):
+async def logout_all_devices(token_data: TokenRefresh, db: AsyncSession = Depends(get_async_db)):
     """
     Cierra sesión en todos los dispositivos invalidando todos los refresh tokens del usuario
     """
     try:
         # Buscar el refresh token para obtener el usuario
-        refresh_token_record = db.query(RefreshToken).filter(
-            RefreshToken.token == token_data.refresh_token,
-            RefreshToken.is_active == "true"
-        ).first()
+        refresh_token_record = await find_active_refresh_token(db, token_data.refresh_token)
         
         if not refresh_token_record:
             raise HTTPException(
@@ -237,12 +217,9 @@ async def logout_all_devices(token_data: TokenRefresh, db: Session = Depends(get
             )
         
         # Invalidar todos los refresh tokens del usuario
-        db.query(RefreshToken).filter(
-            RefreshToken.user_id == refresh_token_record.user_id,
-            RefreshToken.is_active == "true"
-        ).update({"is_active": "false"})
+        await revoke_user_refresh_tokens(db, refresh_token_record.user_id)
         
-        db.commit()
+        await db.commit()
         
         return {"message": "Logout exitoso en todos los dispositivos"}
         
@@ -0,0 +1,127 @@
+import re
+from datetime import timedelta
+from urllib.parse import urlparse, parse_qs
+from app.analyzer import ANALYZER_VERSION
+from app.chord_codec import load_chords
+from app.config import ANALYSIS_CACHE_MAX_ENTRIES, ANALYSIS_CACHE_TTL_SECONDS
+from app.database import SessionLocal, SongHistory, utc_now
+from app.metrics import CACHE_LOOKUPS
+from app.ttl_cache import TTLCache
+
+YOUTUBE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com")
+
+
+_cache = TTLCache(ANALYSIS_CACHE_MAX_ENTRIES, ANALYSIS_CACHE_TTL_SECONDS)
+
+
+# ----------------------------
+# Claves de caché
+# ----------------------------
+def normalize_youtube_id(youtube_url: str):
+    """Extrae el ID de vídeo de las distintas formas de URL de YouTube"""
+    try:
+        parsed = urlparse(youtube_url.strip())
+    except ValueError:
+        return None
+    host = (parsed.hostname or "").lower()
+    parts = [p for p in parsed.path.split("/") if p]
+
+    video_id = None
+    if host == "youtu.be" and parts:
+        video_id = parts[0]
+    elif host in YOUTUBE_HOSTS:
+        if parts[:1] == ["watch"]:
+            video_id = parse_qs(parsed.query).get("v", [None])[0]
+        elif len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+            video_id = parts[1]
+
+    if video_id and YOUTUBE_ID_PATTERN.match(video_id):
+        return video_id
+    return None
+
+
+def window_suffix(start: float = None, end: float = None) -> str:
+    """Parte de la clave que distingue el análisis de un fragmento del de la canción entera"""
+    if start is None and end is None:
+        return ""
+    return f":{start or 0:g}-{'' if end is None else f'{end:g}'}"
+
+
+def link_cache_key(youtube_url: str, vocabulary: str, start: float = None, end: float = None):
+    """Clave de caché de un enlace, o None si no se reconoce el vídeo"""
+    video_id = normalize_youtube_id(youtube_url)
+    if not video_id:
+        return None
+    return f"yt:{video_id}:{ANALYZER_VERSION}:{vocabulary}{window_suffix(start, end)}"
+
+
+def pcm_cache_key(pcm_digest: str, vocabulary: str, start: float = None, end: float = None) -> str:
+    """Clave de caché de un audio subido a partir del SHA-256 de sus muestras PCM decodificadas.
+
+    Se calcula sobre el audio ya decodificado (scan_audio lo va acumulando por
+    trozos) para que el mismo audio dé la misma clave aunque cambien el
+    contenedor o sus metadatos.
+    """
+    return f"pcm:{pcm_digest}:{ANALYZER_VERSION}:{vocabulary}{window_suffix(start, end)}"
+
+
+# ----------------------------
+# Consulta y registro
+# ----------------------------
+def find_cached_analysis(cache_key: str):
+    """Busca un análisis reutilizable en memoria y, si no está, en el historial compartido"""
+    entry = _cache.get(cache_key)
+    if entry:
+        CACHE_LOOKUPS.inc("memory")
+        return entry
+
+    min_date = utc_now() - timedelta(seconds=ANALYSIS_CACHE_TTL_SECONDS)
+    db = SessionLocal()
+    try:
+        song = db.query(
+            SongHistory.job_id,
+            SongHistory.title,
+            SongHistory.tempo_bpm,
+            SongHistory.key_detected,
+            SongHistory.mode_detected,
+            SongHistory.beats_per_bar,
+            SongHistory.chords_json,
+            SongHistory.chords_blob
+        ).filter(
+            SongHistory.cache_key == cache_key,
+            SongHistory.analyzed_at >= min_date
+        ).order_by(SongHistory.analyzed_at.desc()).first()
+    finally:
+        db.close()
+
+    if not song:
+        CACHE_LOOKUPS.inc("miss")
+        return None
+
+    entry = {
+        "source_job_id": song.job_id,
+        "title": song.title,
+        "analysis": {
+            "tempo_bpm": song.tempo_bpm,
+            "key": song.key_detected,
+            "mode": song.mode_detected,
+            "beats_per_bar": song.beats_per_bar,
+            "chords": load_chords(song.chords_blob, song.chords_json),
+        }
+    }
+    _cache.put(cache_key, entry)
+    CACHE_LOOKUPS.inc("db")
+    return entry
+
+
+def remember_analysis(cache_key: str, source_job_id: str, title: str, analysis: dict):
+    _cache.put(cache_key, {
+        "source_job_id": source_job_id,
+        "title": title,
+        "analysis": analysis,
+    })
+
+
+def invalidate_analysis_cache(cache_key: str = None):
+    _cache.invalidate(cache_key)
@@ -0,0 +1,82 @@
+import json
+import struct
+import numpy as np
+
+# Formato binario de una progresión de acordes (little-endian):
+#   cabecera   b"CHD1", flags (u8), n_acordes_distintos (u16), n_compases (u32)
+#   vocabulario  por cada acorde distinto: longitud (u8) + nombre en UTF-8
+#   columnas   start_time (float32[n]), end_time (float32[n]), índice del acorde (uint16[n])
+#              y, solo si los compases no son 1..n, el número de compás (uint32[n])
+# prevChord/nextChord no se guardan: se deducen de los vecinos al decodificar.
+CHORDS_MAGIC = b"CHD1"
+HEADER = struct.Struct("<4sBHI")
+FLAG_EXPLICIT_BARS = 0x01
+
+
+def encode_chords(chords: list) -> bytes:
+    """Empaqueta la lista de compases del análisis en el formato binario columnar"""
+    labels = {}
+    chord_ids = np.array([labels.setdefault(c["chord"], len(labels)) for c in chords], dtype="<u2")
+    start_times = np.array([c["start_time"] for c in chords], dtype="<f4")
+    end_times = np.array([c["end_time"] for c in chords], dtype="<f4")
+    bars = np.array([c["bar"] for c in chords], dtype="<u4")
+
+    flags = 0
+    if not np.array_equal(bars, np.arange(1, len(chords) + 1)):
+        flags |= FLAG_EXPLICIT_BARS
+
+    parts = [HEADER.pack(CHORDS_MAGIC, flags, len(labels), len(chords))]
+    for label in labels:
+        encoded = label.encode()
+        parts.append(struct.pack("<B", len(encoded)) + encoded)
+    parts += [start_times.tobytes(), end_times.tobytes(), chord_ids.tobytes()]
+    if flags & FLAG_EXPLICIT_BARS:
+        parts.append(bars.tobytes())
+    return b"".join(parts)
+
+
+def decode_chords(blob: bytes) -> list:
+    """Reconstruye la lista de compases con la misma forma que devuelve el analizador"""
+    magic, flags, n_labels, n_bars = HEADER.unpack_from(blob)
+    if magic != CHORDS_MAGIC:
+        raise ValueError("Formato de acordes desconocido")
+
+    offset = HEADER.size
+    labels = []
+    for _ in range(n_labels):
+        length = blob[offset]
+        labels.append(blob[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+
+    def column(dtype: str):
+        nonlocal offset
+        values = np.frombuffer(blob, dtype=dtype, count=n_bars, offset=offset)
+        offset += values.nbytes
+        return values
+
+    # Los tiempos se guardan redondeados a centésimas, como los entrega el analizador
+    start_times = np.round(column("<f4").astype(np.float64), 2).tolist()
+    end_times = np.round(column("<f4").astype(np.float64), 2).tolist()
+    names = [labels[i] for i in column("<u2").tolist()]
+    bars = column("<u4").tolist() if flags & FLAG_EXPLICIT_BARS else range(1, n_bars + 1)
+
+    return [
+        {
+            "start_time": start_time,
+            "end_time": end_time,
+            "chord": chord,
+            "bar": bar,
+            "prevChord": names[idx - 1] if idx > 0 else None,
+            "nextChord": names[idx + 1] if idx < n_bars - 1 else None,
+        }
+        for idx, (start_time, end_time, chord, bar) in enumerate(zip(start_times, end_times, names, bars))
+    ]
+
+
+def load_chords(chords_blob, chords_json) -> list:
+    """Acordes de una fila del historial: formato binario o, en filas antiguas, JSON"""
+    if chords_blob:
+        return decode_chords(chords_blob)
+    if isinstance(chords_json, str):
+        return json.loads(chords_json)
+    return chords_json or []
@@ -15,5 +15,46 @@ CHORD_TYPES = [
 
 ALL_CHORDS = [root + chord for root in ROOTS for chord in CHORD_TYPES]
 
+# Intervalos (semitonos desde la fundamental) y peso de cada nota en la plantilla
+CHORD_INTERVALS = {
+    "": [(0, 1.0), (4, 0.95), (7, 0.9)],
+    "m": [(0, 1.0), (3, 0.95), (7, 0.9)],
+    "maj": [(0, 1.0), (4, 0.95), (7, 0.9)],
+    "dim": [(0, 1.0), (3, 0.95), (6, 0.9)],
+    "aug": [(0, 1.0), (4, 0.95), (8, 0.9)],
+    "5": [(0, 1.0), (7, 0.9)],
+    "sus2": [(0, 1.0), (2, 0.95), (7, 0.9)],
+    "sus4": [(0, 1.0), (5, 0.95), (7, 0.9)],
+    "6": [(0, 1.0), (4, 0.85), (7, 0.8), (9, 0.7)],
+    "m6": [(0, 1.0), (3, 0.85), (7, 0.8), (9, 0.7)],
+    "7": [(0, 1.0), (4, 0.85), (7, 0.8), (10, 0.7)],
+    "maj7": [(0, 1.0), (4, 0.85), (7, 0.8), (11, 0.7)],
+    "m7": [(0, 1.0), (3, 0.85), (7, 0.8), (10, 0.7)],
+    "mMaj7": [(0, 1.0), (3, 0.85), (7, 0.8), (11, 0.7)],
+    "dim7": [(0, 1.0), (3, 0.85), (6, 0.8), (9, 0.7)],
+    "m7b5": [(0, 1.0), (3, 0.85), (6, 0.8), (10, 0.7)],
+    "9": [(0, 1.0), (4, 0.8), (7, 0.75), (10, 0.7), (2, 0.6)],
+    "maj9": [(0, 1.0), (4, 0.8), (7, 0.75), (11, 0.7), (2, 0.6)],
+    "m9": [(0, 1.0), (3, 0.8), (7, 0.75), (10, 0.7), (2, 0.6)],
+    "11": [(0, 1.0), (7, 0.75), (10, 0.7), (2, 0.6), (5, 0.6)],
+    "13": [(0, 1.0), (4, 0.8), (7, 0.7), (10, 0.7), (2, 0.5), (9, 0.6)],
+    "add9": [(0, 1.0), (4, 0.9), (7, 0.85), (2, 0.7)],
+    "add11": [(0, 1.0), (4, 0.9), (7, 0.85), (5, 0.7)],
+    "7b9": [(0, 1.0), (4, 0.8), (7, 0.75), (10, 0.7), (1, 0.6)],
+    "7#9": [(0, 1.0), (4, 0.8), (7, 0.75), (10, 0.7), (3, 0.6)],
+    "7b5": [(0, 1.0), (4, 0.85), (6, 0.8), (10, 0.7)],
+    "7#5": [(0, 1.0), (4, 0.85), (8, 0.8), (10, 0.7)],
+}
+
+# Vocabularios seleccionables en cada análisis
+BASIC_CHORD_TYPES = ["", "m", "7", "m7", "maj7"]
+# "maj" tiene las mismas notas que "": en el banco serían filas repetidas y argmax nunca elegiría "maj"
+EXTENDED_CHORD_TYPES = [chord for chord in CHORD_TYPES if chord != "maj"]
+VOCABULARIES = {
+    "basic": BASIC_CHORD_TYPES,
+    "extended": EXTENDED_CHORD_TYPES,
+}
+DEFAULT_VOCABULARY = "basic"
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
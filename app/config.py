@@ -32,8 +32,87 @@ else:
 if not DATABASE_URL:
     raise ValueError("No se pudo configurar DATABASE_URL")
 
+# URL de la conexión asíncrona de los endpoints (app/async_database.py).
+# Vacía = la misma DATABASE_URL con el driver asíncrono (asyncpg, aiomysql o aiosqlite)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "")
+
+# Pool de conexiones (el perfil de cada motor está en app/database.py)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Segundos esperando una conexión libre antes de fallar
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Segundos tras los que se renueva una conexión (por debajo del wait_timeout de MySQL y de los proxies)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Comprobar cada conexión antes de usarla (evita los "MySQL server has gone away")
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Duración máxima de una consulta en milisegundos (0 = sin límite; en MySQL solo afecta a SELECT)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# SQLite: segundos que se espera a que otra conexión libere el bloqueo de escritura
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "15"))
+# SQLite: pool pequeño, con WAL hay lectores concurrentes pero un solo escritor
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "5"))
+SQLITE_MAX_OVERFLOW = int(os.getenv("SQLITE_MAX_OVERFLOW", "5"))
+
 # Configuración JWT
 JWT_SECRET_KEY = os.getenv("JWT_SECRET", "chordmaster_secret_key_2025_development")
+# Tokens de acceso ya verificados que se recuerdan (hasta que caducan)
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "4096"))
+# Limpieza periódica de refresh tokens caducados o revocados (segundos entre pasadas y filas por lote)
+REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS = int(os.getenv("REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS", "3600"))
+REFRESH_TOKEN_SWEEP_BATCH = int(os.getenv("REFRESH_TOKEN_SWEEP_BATCH", "1000"))
+
+# Contraseñas: coste de bcrypt (los hashes con otro coste se rehacen al iniciar sesión)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Hilos dedicados a bcrypt (libera el GIL, así que escala con los núcleos)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+# Segundos que una petición espera un hilo libre antes de recibir 503
+PASSWORD_HASH_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_TIMEOUT_SECONDS", "5"))
+
+# Configuración de los workers de análisis
+# Procesos dedicados al análisis con librosa (por defecto: todos los núcleos menos uno)
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# Análisis admitidos a la vez (descarga + conversión + análisis); el resto recibe 503
+ANALYSIS_MAX_PENDING = int(os.getenv("ANALYSIS_MAX_PENDING", str(ANALYSIS_WORKERS * 2)))
+# Segundos sugeridos al cliente en la cabecera Retry-After cuando el servidor está saturado
+ANALYSIS_RETRY_AFTER = int(os.getenv("ANALYSIS_RETRY_AFTER", "30"))
+# Segundos que se conserva en memoria el estado de un trabajo terminado
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# Lotes (listas de enlaces, playlists o varios archivos)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "10"))
+# Elementos de un mismo lote que se descargan/analizan a la vez
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+# Caché de metadatos de YouTube (título, duración) por vídeo
+YOUTUBE_METADATA_CACHE_MAX_ENTRIES = int(os.getenv("YOUTUBE_METADATA_CACHE_MAX_ENTRIES", "2048"))
+YOUTUBE_METADATA_TTL_SECONDS = int(os.getenv("YOUTUBE_METADATA_TTL_SECONDS", "86400"))
+
+# Duración máxima del audio de un enlace (o del fragmento start/end pedido); 0 = sin límite.
+# Se comprueba antes de descargarlo
+MAX_AUDIO_DURATION_SECONDS = int(os.getenv("MAX_AUDIO_DURATION_MINUTES", "20")) * 60
+# Lo mismo para los archivos subidos; 0 = sin límite (el análisis se hace por bloques
+# desde el archivo, así que la memoria no crece con la duración, solo el tiempo)
+MAX_FILE_DURATION_SECONDS = int(os.getenv("MAX_FILE_DURATION_MINUTES", "0")) * 60
+# Tamaño máximo de un archivo subido para analizar
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "100")) * 1024 * 1024
+
+# Almacenamiento del audio analizado: "local" (disco) o "s3" (bucket compatible con S3)
+AUDIO_STORAGE_BACKEND = os.getenv("AUDIO_STORAGE_BACKEND", "local")
+AUDIO_STORAGE_DIR = os.getenv("AUDIO_STORAGE_DIR", os.path.join("storage", "audio"))
+AUDIO_S3_BUCKET = os.getenv("AUDIO_S3_BUCKET")
+AUDIO_S3_PREFIX = os.getenv("AUDIO_S3_PREFIX", "audio/")
+AUDIO_S3_ENDPOINT_URL = os.getenv("AUDIO_S3_ENDPOINT_URL")  # MinIO, R2...
+
+# Códec del audio guardado: "opus" (con pérdida, el más pequeño), "flac" (sin pérdida) o "wav"
+AUDIO_STORAGE_CODEC = os.getenv("AUDIO_STORAGE_CODEC", "opus")
+AUDIO_OPUS_BITRATE = os.getenv("AUDIO_OPUS_BITRATE", "48k")
+
+# Directorio donde se guardan las plantillas de acordes compiladas (.npy)
+TEMPLATE_BANK_DIR = os.getenv("TEMPLATE_BANK_DIR", os.path.join("cache", "templates"))
+
+# Caché de análisis compartida (por vídeo de YouTube o hash del audio)
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "256"))
+# Antigüedad máxima de un análisis reutilizable (por defecto 7 días)
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "604800"))
 
 # CORS origins
 if IS_PRODUCTION:
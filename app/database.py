@@ -1,14 +1,124 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Float, JSON, LargeBinary
+import enum
+import time
+from sqlalchemy import create_engine, event, inspect, text, Index, Column, Integer, String, CHAR, Enum, DateTime, Text, ForeignKey, Float, JSON, LargeBinary
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from datetime import datetime, timezone
-from app.config import DATABASE_URL
+from app.config import (
+    DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    DB_STATEMENT_TIMEOUT_MS, SQLITE_BUSY_TIMEOUT, SQLITE_POOL_SIZE, SQLITE_MAX_OVERFLOW
+)
+from app.metrics import DB_POOL_WAIT, Gauge
+
+
+class PoolWaitTimer:
+    """Mide la espera hasta obtener una conexión del pool (chordmaster_db_pool_wait_seconds)"""
+    pool_label = "sync"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started, self.pool_label)
+
+
+class TimedQueuePool(PoolWaitTimer, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(PoolWaitTimer, AsyncAdaptedQueuePool):
+    pool_label = "async"
+
+
+# ----------------------------
+# Perfiles del motor por base de datos
+# ----------------------------
+def engine_options(database_url, asynchronous: bool = False) -> dict:
+    """Opciones de create_engine (o create_async_engine) para PostgreSQL (producción), MySQL (desarrollo) o SQLite"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    pool_class = TimedAsyncQueuePool if asynchronous else TimedQueuePool
+    
+    if backend == "sqlite":
+        # Las sesiones se usan desde varios hilos (asyncio.to_thread, pool de uvicorn)
+        options = {"connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT}}
+        if url.database in (None, "", ":memory:"):
+            return options
+        # Pool pequeño (SQLITE_POOL_SIZE): con WAL hay lectores concurrentes pero un solo escritor
+        return {
+            **options,
+            "poolclass": pool_class,
+            "pool_size": SQLITE_POOL_SIZE,
+            "max_overflow": SQLITE_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT
+        }
+    
+    options = {
+        "poolclass": pool_class,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if backend == "postgresql" and DB_STATEMENT_TIMEOUT_MS:
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+def configure_connection(dbapi_connection, backend: str):
+    """Ajustes de cada conexión nueva según el motor"""
+    cursor = dbapi_connection.cursor()
+    try:
+        if backend == "sqlite":
+            # WAL: los lectores no bloquean al escritor (y viceversa)
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        elif backend == "mysql" and DB_STATEMENT_TIMEOUT_MS:
+            cursor.execute(f"SET SESSION max_execution_time = {DB_STATEMENT_TIMEOUT_MS}")
+    finally:
+        cursor.close()
+
+
+def pool_connections(pool) -> dict:
+    """Conexiones del pool en uso y libres (para /metrics)"""
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {("checked_out",): pool.checkedout(), ("idle",): pool.checkedin()}
+
 
 # Crear el motor de la base de datos
-engine = create_engine(DATABASE_URL)
+_engine_options = engine_options(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **_engine_options)
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    configure_connection(dbapi_connection, engine.url.get_backend_name())
+
+Gauge(
+    "chordmaster_db_pool_connections",
+    "Conexiones del pool de la base de datos por estado",
+    lambda: pool_connections(engine.pool),
+    labelnames=("state",)
+)
+Gauge(
+    "chordmaster_db_pool_capacity",
+    "Conexiones máximas del pool (pool_size + max_overflow)",
+    lambda: _engine_options.get("pool_size", 0) + _engine_options.get("max_overflow", 0)
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def utc_now() -> datetime:
+    """Fecha actual en UTC sin zona horaria (como la devuelven MySQL y SQLite)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 # Modelo de Usuario
 class User(Base):
     __tablename__ = "users"
@@ -17,24 +127,36 @@ class User(Base):
     name = Column(String(100), nullable=False)
     email = Column(String(255), unique=True, index=True, nullable=False)
     password = Column(String(255), nullable=False)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utc_now)
     
     # Relación con refresh tokens
     refresh_tokens = relationship("RefreshToken", back_populates="user", cascade="all, delete-orphan")
 
-# Modelo de Refresh Token
+class RefreshTokenStatus(str, enum.Enum):
+    ACTIVE = "active"
+    REVOKED = "revoked"
+
+# Modelo de Refresh Token (tabla refresh_tokens antigua: ver app/refresh_tokens.py)
 class RefreshToken(Base):
-    __tablename__ = "refresh_tokens"
+    __tablename__ = "auth_refresh_tokens"
     
-    id = Column(Integer, primary_key=True, index=True)
-    token = Column(String(500), unique=True, index=True, nullable=False)
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(CHAR(64), unique=True, nullable=False)  # SHA-256 del token; nunca se guarda en claro
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    expires_at = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
-    is_active = Column(String(10), default="true", nullable=False)
+    status = Column(
+        Enum(RefreshTokenStatus, native_enum=False, length=10, values_callable=lambda e: [m.value for m in e]),
+        default=RefreshTokenStatus.ACTIVE, nullable=False
+    )
+    expires_at = Column(DateTime, nullable=False, index=True)  # UTC sin zona horaria; al revocar pasa a ser ya
+    created_at = Column(DateTime, default=utc_now)
     
     # Relación con usuario
     user = relationship("User", back_populates="refresh_tokens")
+    
+    __table_args__ = (
+        # Tokens activos de un usuario (login y logout-all)
+        Index("ix_auth_refresh_tokens_user_id_status", "user_id", "status"),
+    )
 
 # Modelo de Historial de Canciones
 class SongHistory(Base):
@@ -52,12 +174,22 @@ class SongHistory(Base):
     mode_detected = Column(String(20), nullable=True)  # Campo agregado
     beats_per_bar = Column(Integer, nullable=True)  # Campo existente
     chords = Column(JSON, nullable=True)  # Campo original
-    chords_json = Column(JSON, nullable=True)  # Campo agregado
-    audio_data = Column(LargeBinary, nullable=True)  # Almacenar archivo de audio
-    analyzed_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    chords_json = Column(JSON, nullable=True)  # Acordes en JSON (filas antiguas)
+    chords_blob = deferred(Column(LargeBinary, nullable=True))  # Acordes en formato binario (app/chord_codec.py)
+    audio_data = deferred(Column(LargeBinary, nullable=True))  # Audio antiguo en BD (ver migrate_audio.py); nunca se carga salvo que se pida
+    audio_key = Column(String(100), nullable=True, index=True)  # Clave del audio en el almacenamiento (app/storage.py)
+    audio_size = Column(Integer, nullable=True)  # Tamaño del audio en bytes
+    audio_codec = Column(String(20), nullable=True)  # Formato del audio almacenado (wav...)
+    cache_key = Column(String(100), nullable=True, index=True)  # Vídeo/hash del audio + versión del analizador
+    analyzed_at = Column(DateTime, default=utc_now)  # UTC sin zona horaria (asyncpg rechaza fechas con zona en TIMESTAMP)
     
     # Relación con usuario
     user = relationship("User")
+    
+    __table_args__ = (
+        # Historial de un usuario por fecha (paginación por cursor en (analyzed_at, id))
+        Index("ix_song_history_user_id_analyzed_at", "user_id", "analyzed_at", "id"),
+    )
 
 # Función para obtener la sesión de la base de datos
 def get_db():
@@ -70,3 +202,25 @@ def get_db():
 # Crear las tablas
 def create_tables():
     Base.metadata.create_all(bind=engine)
+
+# Añadir a tablas existentes las columnas e índices nuevos del modelo
+def upgrade_schema():
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+                    print(f"  + columna {table.name}.{column.name}")
+            
+            existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    print(f"  + índice {index.name}")
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from collections import Counter
+from app.config import JOB_RETENTION_SECONDS
+from app.metrics import Gauge, STAGE_DURATION
+
+# Etapas de un trabajo de análisis, en orden
+STAGE_QUEUED = "queued"
+STAGE_DOWNLOADING = "downloading"
+STAGE_CONVERTING = "converting"
+STAGE_ANALYZING = "analyzing"
+STAGE_STORING = "storing"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+
+FINAL_STAGES = (STAGE_DONE, STAGE_FAILED)
+
+# Directorio raíz de los archivos temporales de cada trabajo
+JOBS_DIR = "jobs"
+
+
+class AnalysisJob:
+    """Estado en memoria de un análisis y sus suscriptores de eventos (SSE)"""
+
+    def __init__(self, user_id: int, source: str, title: str = None):
+        self.job_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.source = source
+        self.title = title
+        self.stage = STAGE_QUEUED
+        self.partial_chords = []
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.timings = {}
+        self.audio_seconds = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._subscribers = set()
+
+    @property
+    def work_dir(self) -> str:
+        """Directorio de los archivos temporales del trabajo (descarga o subida)"""
+        return os.path.join(JOBS_DIR, self.job_id)
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in FINAL_STAGES
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+        self.updated_at = time.time()
+        self._publish("stage", {"stage": stage, "title": self.title})
+
+    def record_timing(self, stage: str, seconds: float):
+        """Registra la duración de una etapa en el trabajo y en /metrics"""
+        self.timings[stage] = round(self.timings.get(stage, 0.0) + seconds, 4)
+        STAGE_DURATION.observe(seconds, stage)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Mide la duración del bloque como etapa del trabajo"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_timing(stage, time.perf_counter() - started)
+
+    def add_partial_chords(self, bars: list):
+        """Registra compases ya analizados y los envía a los suscriptores"""
+        self.partial_chords.extend(bars)
+        self.updated_at = time.time()
+        self._publish("chords", {"bars": bars})
+
+    def finish(self, result: dict):
+        self.result = result
+        self.stage = STAGE_DONE
+        self.updated_at = time.time()
+        self._publish("done", result)
+
+    def fail(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.error = detail
+        self.stage = STAGE_FAILED
+        self.updated_at = time.time()
+        self._publish("failed", {"status_code": status_code, "detail": detail})
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.job_id,
+            "stage": self.stage,
+            "title": self.title,
+            "source": self.source,
+            "bars_analyzed": len(self.partial_chords),
+            "audio_seconds": self.audio_seconds,
+            "timings": self.timings,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+        if self.stage == STAGE_DONE:
+            data["result"] = self.result
+        if self.stage == STAGE_FAILED:
+            data["error"] = {"status_code": self.status_code, "detail": self.error}
+        return data
+
+    # ----------------------------
+    # Eventos (SSE)
+    # ----------------------------
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def _publish(self, event: str, data: dict):
+        for queue in self._subscribers:
+            queue.put_nowait((event, data))
+
+    async def events(self, keepalive: float = 15.0):
+        """Genera el stream SSE: estado actual, compases ya calculados y cambios posteriores"""
+        # La foto del estado se toma junto con la suscripción para no duplicar ni perder eventos
+        queue = self.subscribe()
+        stage, title, bars = self.stage, self.title, list(self.partial_chords)
+        try:
+            yield format_sse("stage", {"stage": stage, "title": title})
+            if bars:
+                yield format_sse("chords", {"bars": bars})
+            if stage == STAGE_DONE:
+                yield format_sse("done", self.result)
+                return
+            if stage == STAGE_FAILED:
+                yield format_sse("failed", {"status_code": self.status_code, "detail": self.error})
+                return
+
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    # Comentario SSE para que los proxies no cierren la conexión
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+                if event in ("done", "failed"):
+                    return
+        finally:
+            self.unsubscribe(queue)
+
+
+class AnalysisBatch:
+    """Grupo de trabajos enviados juntos (lista de enlaces, playlist o varios archivos)"""
+
+    def __init__(self, user_id: int, source: str):
+        self.batch_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.source = source
+        self.jobs = []
+        self.skipped = []
+        self.created_at = time.time()
+
+    @property
+    def finished(self) -> bool:
+        return all(job.finished for job in self.jobs)
+
+    @property
+    def updated_at(self) -> float:
+        return max([self.created_at] + [job.updated_at for job in self.jobs])
+
+    def to_dict(self) -> dict:
+        stages = Counter(job.stage for job in self.jobs)
+        total = len(self.jobs)
+        finished = stages[STAGE_DONE] + stages[STAGE_FAILED]
+        return {
+            "batch_id": self.batch_id,
+            "source": self.source,
+            "total": total,
+            "done": stages[STAGE_DONE],
+            "failed": stages[STAGE_FAILED],
+            "pending": total - finished,
+            "progress": round(finished / total, 3) if total else 1.0,
+            "stages": dict(stages),
+            "skipped": self.skipped,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "items": [
+                {
+                    "job_id": job.job_id,
+                    "title": job.title,
+                    "stage": job.stage,
+                    "bars_analyzed": len(job.partial_chords),
+                    "error": {"status_code": job.status_code, "detail": job.error} if job.error else None,
+                }
+                for job in self.jobs
+            ],
+        }
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# ----------------------------
+# Registro de trabajos
+# ----------------------------
+# Los trabajos viven en memoria del proceso: con varios workers de uvicorn
+# el cliente debe consultar el mismo proceso que creó el trabajo.
+_jobs = {}
+_batches = {}
+
+# Referencias a las tareas en segundo plano para que el recolector no las cancele
+_background_tasks = set()
+
+
+def create_job(user_id: int, source: str, title: str = None) -> AnalysisJob:
+    _purge_expired()
+    job = AnalysisJob(user_id, source, title)
+    _jobs[job.job_id] = job
+    return job
+
+
+def create_batch(user_id: int, source: str) -> AnalysisBatch:
+    _purge_expired()
+    batch = AnalysisBatch(user_id, source)
+    _batches[batch.batch_id] = batch
+    return batch
+
+
+def get_batch(batch_id: str, user_id: int):
+    """Devuelve el lote si existe y pertenece al usuario"""
+    batch = _batches.get(batch_id)
+    if batch is None or batch.user_id != user_id:
+        return None
+    return batch
+
+
+def start_background(coro) -> asyncio.Task:
+    """Lanza una corrutina en segundo plano manteniendo una referencia a ella"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def get_job(job_id: str, user_id: int):
+    """Devuelve el trabajo si existe y pertenece al usuario"""
+    job = _jobs.get(job_id)
+    if job is None or job.user_id != user_id:
+        return None
+    return job
+
+
+def jobs_by_stage() -> dict:
+    return {(stage,): count for stage, count in Counter(job.stage for job in _jobs.values()).items()}
+
+
+Gauge("chordmaster_jobs", "Trabajos registrados en memoria por etapa", jobs_by_stage, labelnames=("stage",))
+
+
+def _purge_expired():
+    """Elimina los trabajos y lotes terminados hace más de JOB_RETENTION_SECONDS"""
+    limit = time.time() - JOB_RETENTION_SECONDS
+    expired = [job_id for job_id, job in _jobs.items() if job.finished and job.updated_at < limit]
+    for job_id in expired:
+        del _jobs[job_id]
+    expired = [batch_id for batch_id, batch in _batches.items() if batch.finished and batch.updated_at < limit]
+    for batch_id in expired:
+        del _batches[batch_id]
@@ -0,0 +1,172 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Métricas en memoria del proceso, expuestas en /metrics con el formato de texto
+# de Prometheus. Con varios workers de uvicorn cada proceso tiene las suyas.
+
+# Límites de los buckets (segundos) de las duraciones de cada etapa
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Duración del audio analizado (segundos)
+AUDIO_BUCKETS = (30, 60, 120, 180, 240, 300, 420, 600, 900, 1800)
+# Segundos de proceso por segundo de audio
+REALTIME_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+# Espera por una conexión del pool de la base de datos (segundos)
+DB_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge:
+    """Valor que se lee al generar /metrics: func() devuelve un número o,
+    con etiquetas, un dict {(valores de etiquetas): número}"""
+
+    def __init__(self, name: str, help_text: str, func, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.labelnames = labelnames
+        # etiquetas -> [recuento por bucket (no acumulado), suma, total]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(bound)}"'
+                    yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+                yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+def render_metrics() -> str:
+    """Todas las métricas registradas en formato de texto de Prometheus (0.0.4)"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------------
+# Métricas del pipeline de análisis
+# ----------------------------
+STAGE_DURATION = Histogram(
+    "chordmaster_stage_duration_seconds",
+    "Duración de cada etapa del análisis",
+    STAGE_BUCKETS,
+    labelnames=("stage",)
+)
+AUDIO_DURATION = Histogram(
+    "chordmaster_audio_duration_seconds",
+    "Duración del audio analizado",
+    AUDIO_BUCKETS
+)
+REALTIME_FACTOR = Histogram(
+    "chordmaster_processing_realtime_factor",
+    "Segundos de proceso por segundo de audio analizado",
+    REALTIME_BUCKETS
+)
+JOBS_FINISHED = Counter(
+    "chordmaster_jobs_finished_total",
+    "Análisis terminados por resultado",
+    labelnames=("result",)
+)
+CACHE_LOOKUPS = Counter(
+    "chordmaster_analysis_cache_lookups_total",
+    "Consultas a la caché de análisis por resultado (memory, db o miss)",
+    labelnames=("result",)
+)
+
+
+def cache_hit_ratio() -> float:
+    hits = CACHE_LOOKUPS.value("memory") + CACHE_LOOKUPS.value("db")
+    total = hits + CACHE_LOOKUPS.value("miss")
+    return hits / total if total else 0.0
+
+
+Gauge(
+    "chordmaster_analysis_cache_hit_ratio",
+    "Proporción de análisis servidos desde la caché",
+    cache_hit_ratio
+)
+
+
+# ----------------------------
+# Métricas de la base de datos
+# ----------------------------
+DB_POOL_WAIT = Histogram(
+    "chordmaster_db_pool_wait_seconds",
+    "Tiempo hasta obtener una conexión del pool de la base de datos (pool: sync o async)",
+    DB_WAIT_BUCKETS,
+    labelnames=("pool",)
+)
@@ -0,0 +1,139 @@
+import io
+import re
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+# Bytes enviados en cada trozo de la respuesta: la memoria por reproducción no depende del archivo
+STREAM_CHUNK_BYTES = 64 * 1024
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# ----------------------------
+# Cabeceras Range
+# ----------------------------
+def parse_range(range_header: str, size: int):
+    """Devuelve (inicio, fin) incluidos del rango pedido, o None para enviar el archivo completo.
+
+    Solo se atiende un rango simple (bytes=a-b, bytes=a- o bytes=-n); con varios
+    rangos se envía el archivo completo, como permite el RFC 9110. Lanza 416 si
+    el rango queda fuera del archivo.
+    """
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Sufijo: los últimos n bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Rango no satisfacible",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Comprueba una cabecera If-None-Match / If-Range contra la ETag del audio"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+# ----------------------------
+# Respuesta de audio
+# ----------------------------
+def iter_stream(open_stream, start: int, end: int):
+    """Lee el tramo [start, end] por trozos y cierra el stream al terminar (o si el cliente corta).
+
+    Se itera en el threadpool de Starlette, así que abrir y leer del
+    almacenamiento no bloquea el event loop.
+    """
+    stream = open_stream(start, end)
+    try:
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = stream.read(min(STREAM_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def audio_headers(etag: str, filename: str, accept_ranges: str = "bytes") -> dict:
+    return {
+        "Accept-Ranges": accept_ranges,
+        "ETag": etag,
+        # El audio de un análisis no cambia: el navegador puede revalidar con la ETag
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"inline; filename=\"{filename}\"",
+    }
+
+
+def audio_response(request: Request, open_stream, size: int, etag: str, media_type: str, filename: str):
+    """Respuesta de audio con soporte de Range (206), ETag (304) y envío por trozos.
+
+    open_stream(start, end) abre el audio a partir del byte start; solo se llama
+    cuando hay que enviar contenido.
+    """
+    headers = audio_headers(etag, filename)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = parse_range(request.headers.get("range"), size)
+    if_range = request.headers.get("if-range")
+    if byte_range and if_range and not etag_matches(if_range, etag):
+        # El cliente tenía otra versión: se envía el archivo completo
+        byte_range = None
+
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_stream(open_stream, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers
+    )
+
+
+def streamed_audio_response(request: Request, iter_chunks, etag: str, media_type: str, filename: str):
+    """Respuesta de audio generado al vuelo (tamaño desconocido): ETag (304), sin Range.
+
+    iter_chunks() devuelve el iterador de trozos; solo se llama cuando hay que
+    enviar contenido, así que una revalidación no genera nada.
+    """
+    headers = audio_headers(etag, filename, accept_ranges="none")
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(iter_chunks(), media_type=media_type, headers=headers)
+
+
+def bytes_opener(data: bytes):
+    """open_stream para audio ya cargado en memoria (filas antiguas con el audio en la BD)"""
+    def open_stream(start: int, end: int):
+        stream = io.BytesIO(data)
+        stream.seek(start)
+        return stream
+    return open_stream
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+from sqlalchemy import MetaData, Table, inspect, select, update
+from app.auth import create_refresh_token, get_refresh_token_expiry
+from app.config import REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS, REFRESH_TOKEN_SWEEP_BATCH
+from app.database import engine, SessionLocal, RefreshToken, RefreshTokenStatus, utc_now
+
+# Tabla de la versión anterior (token en claro, is_active "true"/"false")
+LEGACY_TABLE = "refresh_tokens"
+
+
+def hash_refresh_token(token: str) -> str:
+    """SHA-256 del token (64 caracteres hex). El token es aleatorio, así que no necesita sal"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+# Los endpoints usan una AsyncSession (app/async_database.py); el barrido y la migración, el motor síncrono
+def issue_refresh_token(db, user_id: int) -> str:
+    """Crea un refresh token para el usuario y devuelve el token en claro (sin hacer commit)"""
+    token = create_refresh_token()
+    db.add(RefreshToken(
+        token_hash=hash_refresh_token(token),
+        user_id=user_id,
+        expires_at=get_refresh_token_expiry()
+    ))
+    return token
+
+
+async def find_active_refresh_token(db, token: str):
+    """Fila activa del token (búsqueda por el índice único del hash), o None"""
+    return await db.scalar(select(RefreshToken).where(
+        RefreshToken.token_hash == hash_refresh_token(token),
+        RefreshToken.status == RefreshTokenStatus.ACTIVE
+    ))
+
+
+# Al revocar, expires_at pasa a ser "ahora": así el barrido solo necesita el índice de expires_at
+def revoke_refresh_token(record: RefreshToken):
+    """Revoca un token ya cargado (sin hacer commit)"""
+    record.status = RefreshTokenStatus.REVOKED
+    record.expires_at = utc_now()
+
+
+async def revoke_user_refresh_tokens(db, user_id: int):
+    """Revoca todos los tokens activos del usuario con un solo UPDATE por (user_id, status)"""
+    await db.execute(
+        update(RefreshToken).where(
+            RefreshToken.user_id == user_id,
+            RefreshToken.status == RefreshTokenStatus.ACTIVE
+        ).values(status=RefreshTokenStatus.REVOKED, expires_at=utc_now()),
+        execution_options={"synchronize_session": False}
+    )
+
+
+# ----------------------------
+# Barrido de tokens caducados o revocados
+# ----------------------------
+def sweep_refresh_tokens(batch_size: int = REFRESH_TOKEN_SWEEP_BATCH) -> int:
+    """Borra por lotes los tokens caducados o revocados y devuelve cuántos borró.
+
+    Cada lote es una transacción corta para no bloquear la tabla mientras
+    se inician sesiones.
+    """
+    deleted = 0
+    db = SessionLocal()
+    try:
+        while True:
+            ids = [row.id for row in db.query(RefreshToken.id).filter(
+                RefreshToken.expires_at < utc_now()
+            ).limit(batch_size)]
+            if not ids:
+                break
+            db.query(RefreshToken).filter(RefreshToken.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+    finally:
+        db.close()
+    return deleted
+
+
+async def run_refresh_token_sweeper():
+    """Tarea de fondo: barre los tokens cada REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS"""
+    while True:
+        try:
+            deleted = await asyncio.to_thread(sweep_refresh_tokens)
+            if deleted:
+                print(f"🧹 {deleted} refresh tokens caducados o revocados eliminados")
+        except Exception as e:
+            print(f"❌ Error barriendo refresh tokens: {e}")
+        await asyncio.sleep(REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS)
+
+
+# ----------------------------
+# Migración desde la tabla antigua
+# ----------------------------
+def import_legacy_refresh_tokens() -> int:
+    """Copia (hasheados) los tokens activos de la tabla antigua y la elimina.
+
+    Devuelve cuántos tokens se copiaron; no hace nada si la tabla ya no existe.
+    """
+    if not inspect(engine).has_table(LEGACY_TABLE):
+        return 0
+
+    with engine.begin() as conn:
+        # Tabla reflejada (y no SQL en texto) para que expires_at llegue como datetime también en SQLite
+        legacy = Table(LEGACY_TABLE, MetaData(), autoload_with=conn)
+        rows = conn.execute(
+            select(legacy.c.token, legacy.c.user_id, legacy.c.expires_at).where(legacy.c.is_active == "true")
+        ).fetchall()
+        now = utc_now()
+        records = [
+            {
+                "token_hash": hash_refresh_token(token),
+                "user_id": user_id,
+                "status": RefreshTokenStatus.ACTIVE,
+                "expires_at": expires_at.replace(tzinfo=None),
+                "created_at": now
+            }
+            for token, user_id, expires_at in rows
+            if expires_at is not None and expires_at.replace(tzinfo=None) > now
+        ]
+        if records:
+            conn.execute(RefreshToken.__table__.insert(), records)
+        legacy.drop(conn)
+    return len(records)
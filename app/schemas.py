@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
+from typing import List, Literal, Optional
 
 class UserRegister(BaseModel):
     name: str
@@ -44,8 +45,15 @@ class AccessTokenResponse(BaseModel):
     access_token: str
     token_type: str
 
+# Vocabulario de acordes candidatos (ver app/chords.py)
+Vocabulary = Literal["basic", "extended"]
+
 class AnalyzeLinkRequest(BaseModel):
     youtube_url: str
+    vocabulary: Vocabulary = "basic"
+    # Fragmento a analizar, en segundos (por defecto, el vídeo entero)
+    start: Optional[float] = Field(None, ge=0)
+    end: Optional[float] = Field(None, gt=0)
     
 class AnalyzeFileRequest(BaseModel):
     file: bytes
@@ -64,4 +72,26 @@ class AnalyzeResponse(BaseModel):
         "key": str,
         "chords": list[ChordsResponse]
     }
-    title: str
\ No newline at end of file
+    title: str
+
+class AnalysisJobResponse(BaseModel):
+    job_id: str
+    stage: str
+    status_url: str
+    events_url: str
+
+class BatchLinkRequest(BaseModel):
+    urls: List[str] = []
+    playlist_url: Optional[str] = None
+    vocabulary: Vocabulary = "basic"
+
+class BatchResponse(BaseModel):
+    batch_id: str
+    total: int
+    skipped: List[dict]
+    status_url: str
+    jobs: List[AnalysisJobResponse]
+
+class HistoryPage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from sqlalchemy import select
+from sqlalchemy.orm import undefer
+from app.database import SongHistory
+from app.config import (
+    AUDIO_STORAGE_BACKEND, AUDIO_STORAGE_DIR,
+    AUDIO_S3_BUCKET, AUDIO_S3_PREFIX, AUDIO_S3_ENDPOINT_URL
+)
+
+# Bytes leídos de cada vez al calcular la clave de un archivo
+FILE_HASH_CHUNK_BYTES = 1 << 20
+
+
+class AudioStorage:
+    """Interfaz de almacenamiento de audio por clave (estilo S3: put/get/head/delete)"""
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def put_file(self, key: str, path: str):
+        """Guarda el contenido de un archivo local (los backends lo copian sin leerlo entero)"""
+        with open(path, "rb") as f:
+            self.put(key, f.read())
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def open(self, key: str, start: int = 0, end: int = None):
+        """Devuelve un objeto con read(n) para leer el audio por bloques,
+        desde el byte start (y, si se indica, hasta end incluido)"""
+        raise NotImplementedError
+
+    def size(self, key: str):
+        """Tamaño en bytes, o None si la clave no existe"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        return self.size(key) is not None
+
+
+# ----------------------------
+# Sistema de archivos local
+# ----------------------------
+class LocalAudioStorage(AudioStorage):
+    """Archivos en disco repartidos en subdirectorios por prefijo de la clave
+    (ab/cd/abcd...) para no acumular miles de archivos en un mismo directorio.
+    Sirve también como sustituto local de S3 en desarrollo."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, key: str, data: bytes):
+        self._write(key, lambda f: f.write(data))
+
+    def put_file(self, key: str, path: str):
+        def copy(f):
+            with open(path, "rb") as source:
+                shutil.copyfileobj(source, f)
+        self._write(key, copy)
+
+    def _write(self, key: str, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Escritura atómica: un lector nunca ve un archivo a medias.
+        # Temporal único por llamada: dos hilos pueden guardar a la vez la misma clave
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            # La clave es el hash del contenido: si otro ya la guardó, el resultado es el mismo
+            if not os.path.exists(path):
+                raise
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def open(self, key: str, start: int = 0, end: int = None):
+        f = open(self._path(key), "rb")
+        f.seek(start)
+        return f
+
+    def size(self, key: str):
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+# ----------------------------
+# Almacenamiento compatible con S3 (AWS, MinIO, R2...)
+# ----------------------------
+class S3AudioStorage(AudioStorage):
+    """Bucket compatible con S3. Requiere boto3 (dependencia opcional);
+    las credenciales se leen de las variables AWS_* habituales."""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("AUDIO_STORAGE_BACKEND=s3 requiere instalar boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def put_file(self, key: str, path: str):
+        # Subida por partes (multipart) sin cargar el archivo en memoria
+        self.client.upload_file(path, self.bucket, self._key(key))
+
+    def get(self, key: str) -> bytes:
+        return self.open(key).read()
+
+    def open(self, key: str, start: int = 0, end: int = None):
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if start or end is not None:
+            # Solo se descarga del bucket el tramo pedido
+            params["Range"] = f"bytes={start}-{'' if end is None else end}"
+        return self.client.get_object(**params)["Body"]
+
+    def size(self, key: str):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+@lru_cache(maxsize=None)
+def get_storage() -> AudioStorage:
+    """Backend de audio configurado (AUDIO_STORAGE_BACKEND)"""
+    if AUDIO_STORAGE_BACKEND == "s3":
+        return S3AudioStorage(AUDIO_S3_BUCKET, AUDIO_S3_PREFIX, AUDIO_S3_ENDPOINT_URL)
+    return LocalAudioStorage(AUDIO_STORAGE_DIR)
+
+
+def store_audio(data: bytes) -> str:
+    """Guarda el audio y devuelve su clave (hash del contenido).
+
+    El mismo audio siempre tiene la misma clave, así que los análisis
+    reutilizados desde la caché comparten un único archivo.
+    """
+    key = hashlib.sha256(data).hexdigest()
+    storage = get_storage()
+    if not storage.exists(key):
+        storage.put(key, data)
+    return key
+
+
+def store_audio_file(path: str):
+    """Como store_audio, pero con el audio en un archivo (que se lee por bloques).
+
+    Devuelve (clave, tamaño en bytes).
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(FILE_HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+    key = digest.hexdigest()
+    storage = get_storage()
+    if not storage.exists(key):
+        storage.put_file(key, path)
+    return key, os.path.getsize(path)
+
+
+def migrate_song_audio(db, song_id: int) -> bool:
+    """Mueve al almacenamiento el audio de una fila antigua guardado en la BD"""
+    song = db.query(SongHistory).options(undefer(SongHistory.audio_data)).filter(SongHistory.id == song_id).first()
+    if not song or not song.audio_data:
+        return False
+    song.audio_key = store_audio(song.audio_data)
+    song.audio_size = len(song.audio_data)
+    song.audio_codec = "wav"
+    song.audio_data = None
+    db.commit()
+    return True
+
+
+def release_audio(db, audio_key: str):
+    """Borra el audio del almacenamiento si ya ninguna fila del historial lo usa"""
+    if db.query(SongHistory.id).filter(SongHistory.audio_key == audio_key).first() is None:
+        get_storage().delete(audio_key)
+
+
+async def release_audio_async(db, audio_key: str):
+    """release_audio con una AsyncSession (el borrado en el almacenamiento va a un hilo)"""
+    if await db.scalar(select(SongHistory.id).where(SongHistory.audio_key == audio_key).limit(1)) is None:
+        await asyncio.to_thread(get_storage().delete, audio_key)
@@ -0,0 +1,74 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import NamedTuple
+import numpy as np
+from app.chords import ROOTS, CHORD_INTERVALS, VOCABULARIES
+from app.config import TEMPLATE_BANK_DIR
+
+
+class ChordTemplates(NamedTuple):
+    labels: np.ndarray   # (n_acordes,) nombre de cada acorde
+    matrix: np.ndarray   # (n_acordes, 12) plantillas normalizadas (float32, solo lectura)
+    roots: np.ndarray    # (n_acordes,) índice de la fundamental en ROOTS
+
+
+def vocabulary_chords(vocabulary: str):
+    """Pares (fundamental, tipo) del vocabulario, en el orden de las filas del banco"""
+    if vocabulary not in VOCABULARIES:
+        raise ValueError(f"Vocabulario de acordes desconocido: {vocabulary}")
+    return [(r_idx, chord_type) for r_idx in range(len(ROOTS)) for chord_type in VOCABULARIES[vocabulary]]
+
+
+def compile_template_bank(vocabulary: str) -> np.ndarray:
+    """Compila las plantillas del vocabulario en una matriz contigua (n_acordes, 12)"""
+    chords = vocabulary_chords(vocabulary)
+    matrix = np.zeros((len(chords), 12), dtype=np.float32)
+    for row, (r_idx, chord_type) in enumerate(chords):
+        for semitone, weight in CHORD_INTERVALS[chord_type]:
+            matrix[row, (r_idx + semitone) % 12] = weight
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _bank_path(vocabulary: str) -> str:
+    # La huella de las tablas forma parte del nombre: si cambian, se compila un archivo nuevo
+    chord_types = VOCABULARIES[vocabulary]
+    table = repr([(chord_type, CHORD_INTERVALS[chord_type]) for chord_type in chord_types])
+    fingerprint = hashlib.sha1(table.encode()).hexdigest()[:12]
+    return os.path.join(TEMPLATE_BANK_DIR, f"{vocabulary}-{fingerprint}.npy")
+
+
+@lru_cache(maxsize=None)
+def load_template_bank(vocabulary: str) -> ChordTemplates:
+    """Carga el banco compilado del vocabulario, mapeado en memoria desde disco.
+
+    Si el archivo .npy no existe se compila y se guarda; si el disco no es
+    escribible se usa la matriz compilada en memoria.
+    """
+    chords = vocabulary_chords(vocabulary)
+    labels = np.array([ROOTS[r_idx] + chord_type for r_idx, chord_type in chords])
+    roots = np.array([r_idx for r_idx, _ in chords])
+
+    path = _bank_path(vocabulary)
+    if not os.path.exists(path):
+        matrix = compile_template_bank(vocabulary)
+        try:
+            os.makedirs(TEMPLATE_BANK_DIR, exist_ok=True)
+            # Escritura atómica: varios workers pueden compilar a la vez
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, matrix)
+            os.replace(tmp_path, path)
+        except OSError:
+            matrix.setflags(write=False)
+            return ChordTemplates(labels, matrix, roots)
+
+    matrix = np.load(path, mmap_mode="r")
+    return ChordTemplates(labels, matrix, roots)
+
+
+def preload_template_banks():
+    """Carga todos los vocabularios (al arrancar cada worker de análisis)"""
+    for vocabulary in VOCABULARIES:
+        load_template_bank(vocabulary)
@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Caché LRU en memoria con caducidad por entrada (análisis, metadatos de YouTube, tokens verificados)"""
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        # Se consulta desde hilos (asyncio.to_thread)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: dict, ttl_seconds: float = None):
+        """Guarda value; ttl_seconds sustituye a la caducidad por defecto para esta entrada"""
+        with self._lock:
+            ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str = None):
+        """Elimina una entrada, o todas si no se indica clave"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,107 @@
+import asyncio
+import os
+from fastapi import HTTPException, UploadFile
+from app.config import UPLOAD_MAX_BYTES, MAX_AUDIO_DURATION_SECONDS
+
+# Bytes leídos de cada vez: la memoria por subida no depende del tamaño del archivo
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+
+# ----------------------------
+# Detección del contenedor por la cabecera
+# ----------------------------
+def sniff_audio_container(header: bytes):
+    """Identifica el contenedor de audio por sus primeros bytes, o None si no se reconoce"""
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "wav"
+    if header[:4] == b"fLaC":
+        return "flac"
+    if header[:4] == b"OggS":
+        return "ogg"
+    if header[:3] == b"ID3":
+        return "mp3"
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # Sincronía de trama MPEG (mp3) o ADTS (aac)
+        return "mpeg"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if header[:4] == b"caff":
+        return "caf"
+    if header[:8] == b"\x30\x26\xb2\x75\x8e\x66\xcf\x11":
+        return "wma"
+    return None
+
+
+# ----------------------------
+# Guardar la subida por bloques
+# ----------------------------
+async def save_upload(file: UploadFile, job_dir: str) -> str:
+    """Guarda el archivo subido en el directorio del trabajo por bloques de tamaño fijo.
+
+    Rechaza con 413 los archivos que superan UPLOAD_MAX_BYTES y con 415 los que
+    no empiezan por la cabecera de un formato de audio conocido.
+    """
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise_too_large()
+
+    first_chunk = await file.read(UPLOAD_CHUNK_BYTES)
+    if not sniff_audio_container(first_chunk[:64]):
+        raise HTTPException(
+            status_code=415,
+            detail="Formato de audio no soportado. Sube un archivo WAV, MP3, FLAC, OGG, M4A, WEBM o AIFF."
+        )
+
+    os.makedirs(job_dir, exist_ok=True)
+    # Solo el nombre base: el nombre lo elige el cliente
+    filename = os.path.basename(file.filename or "") or "audio"
+    upload_path = os.path.join(job_dir, f"upload_{filename}")
+
+    # Toda la copia (apertura, escrituras y borrado si falla) en un hilo: no bloquea el event loop
+    await asyncio.to_thread(copy_upload, file.file, first_chunk, upload_path)
+    return upload_path
+
+
+def copy_upload(source, first_chunk: bytes, upload_path: str):
+    """Escribe first_chunk y el resto de source en upload_path por bloques (se ejecuta en un hilo)"""
+    total = 0
+    chunk = first_chunk
+    try:
+        with open(upload_path, "wb") as f:
+            while chunk:
+                total += len(chunk)
+                if total > UPLOAD_MAX_BYTES:
+                    raise_too_large()
+                f.write(chunk)
+                chunk = source.read(UPLOAD_CHUNK_BYTES)
+    except Exception:
+        os.remove(upload_path)
+        raise
+
+
+def raise_too_large():
+    raise HTTPException(
+        status_code=413,
+        detail=f"El archivo supera el tamaño máximo permitido ({UPLOAD_MAX_BYTES // (1024 * 1024)} MB)."
+    )
+
+
+def raise_too_long(seconds: float, max_seconds: int = MAX_AUDIO_DURATION_SECONDS):
+    raise HTTPException(
+        status_code=400,
+        detail=(
+            f"El audio dura {seconds / 60:.1f} min y el máximo es {max_seconds // 60} min. "
+            "Indica start y end (segundos) para analizar solo un fragmento."
+        )
+    )
+
+
+def check_audio_window(start: float = None, end: float = None, max_seconds: int = MAX_AUDIO_DURATION_SECONDS):
+    """Valida el fragmento pedido (start/end en segundos) contra la duración máxima (0 = sin límite)"""
+    if end is not None and end <= (start or 0):
+        raise HTTPException(status_code=400, detail="end debe ser mayor que start")
+    if max_seconds and end is not None and end - (start or 0) > max_seconds:
+        raise_too_long(end - (start or 0), max_seconds)
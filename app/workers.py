@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from app.config import ANALYSIS_WORKERS, ANALYSIS_MAX_PENDING, ANALYSIS_RETRY_AFTER
+from app.metrics import Gauge
+from app.template_bank import preload_template_banks
+
+# Pool de procesos para la etapa de análisis (CPU-bound). Se crea bajo demanda
+# con "spawn" para no heredar el event loop ni las conexiones a la BD.
+_executor = None
+
+# Hilos que esperan el progreso de los análisis en curso (uno por análisis admitido).
+# Separados del executor por defecto de asyncio, que usan las descargas, la caché y el historial
+_progress_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_PENDING, thread_name_prefix="analysis-progress")
+
+# Segundos que un hilo de progreso espera datos antes de comprobar si el análisis terminó
+PROGRESS_POLL_SECONDS = 0.5
+
+# Análisis admitidos actualmente. Solo se modifica desde el event loop,
+# así que no necesita lock.
+_in_flight = 0
+
+# Trabajos en segundo plano esperando un hueco (futures, en orden de llegada)
+_slot_waiters = deque()
+
+# Tareas enviadas al pool de procesos que aún no han terminado
+_pool_pending = 0
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Devuelve el pool de procesos de análisis, creándolo si no existe"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=ANALYSIS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            # Cada worker carga las plantillas de acordes al arrancar
+            initializer=preload_template_banks
+        )
+    return _executor
+
+
+def shutdown_workers():
+    """Cierra el pool de procesos (al apagar la aplicación)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def in_flight_jobs() -> int:
+    """Número de análisis admitidos en este momento"""
+    return _in_flight
+
+
+def pool_queue_depth() -> int:
+    """Tareas enviadas al pool que esperan a que quede un worker libre"""
+    return max(_pool_pending - ANALYSIS_WORKERS, 0)
+
+
+Gauge("chordmaster_analysis_in_flight", "Análisis admitidos en curso", in_flight_jobs)
+Gauge("chordmaster_analysis_queue_depth", "Análisis esperando un worker libre", pool_queue_depth)
+Gauge("chordmaster_analysis_workers", "Procesos de análisis configurados", lambda: ANALYSIS_WORKERS)
+
+
+# ----------------------------
+# Control de admisión
+# ----------------------------
+def reserve_analysis_slot():
+    """Reserva un hueco de análisis o responde 503 si el servidor está saturado.
+
+    Cada reserva debe liberarse con release_analysis_slot().
+    """
+    global _in_flight
+    if _in_flight >= ANALYSIS_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="El servidor está procesando demasiados análisis. Inténtalo de nuevo en unos segundos.",
+            headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)}
+        )
+    _in_flight += 1
+
+
+def release_analysis_slot():
+    """Libera un hueco; si hay trabajos esperando, se lo cede al más antiguo"""
+    global _in_flight
+    while _slot_waiters:
+        waiter = _slot_waiters.popleft()
+        if not waiter.done():
+            # El hueco pasa directamente al que espera: _in_flight no cambia y
+            # una petición síncrona no puede adelantarse
+            waiter.set_result(None)
+            return
+    _in_flight -= 1
+
+
+async def wait_for_analysis_slot():
+    """Como reserve_analysis_slot, pero espera a que quede un hueco libre en vez de
+    responder 503 (para trabajos en segundo plano, como los elementos de un lote).
+    Los que esperan reciben los huecos en orden de llegada."""
+    global _in_flight
+    if _in_flight < ANALYSIS_MAX_PENDING and not _slot_waiters:
+        _in_flight += 1
+        return
+
+    waiter = asyncio.get_running_loop().create_future()
+    _slot_waiters.append(waiter)
+    try:
+        await waiter
+    except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+            # Se canceló justo después de recibir el hueco: pasa al siguiente
+            release_analysis_slot()
+        raise
+
+
+@asynccontextmanager
+async def analysis_slot():
+    """Reserva un hueco de análisis mientras dura el bloque"""
+    reserve_analysis_slot()
+    try:
+        yield
+    finally:
+        release_analysis_slot()
+
+
+# ----------------------------
+# Ejecución en el pool de procesos
+# ----------------------------
+async def run_in_worker(func, *args):
+    """Ejecuta func(*args) en el pool de procesos sin bloquear el event loop"""
+    global _executor, _pool_pending
+    loop = asyncio.get_running_loop()
+    _pool_pending += 1
+    try:
+        return await loop.run_in_executor(get_executor(), func, *args)
+    except BrokenProcessPool:
+        # Un worker murió (p. ej. OOM): se descarta el pool para que el siguiente análisis cree uno nuevo
+        _executor = None
+        raise HTTPException(
+            status_code=503,
+            detail="El worker de análisis se reinició. Inténtalo de nuevo.",
+            headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)}
+        )
+    finally:
+        _pool_pending -= 1
+
+
+# Valor de _receive_progress cuando no llegó nada a tiempo (None es la marca de fin)
+_NO_PROGRESS = object()
+
+
+def _call_with_progress(progress_writer, func, args):
+    """Se ejecuta en el worker: reenvía el progreso de func por la tubería"""
+    try:
+        return func(*args, progress_writer.send)
+    finally:
+        # Marca de fin para que el proceso principal deje de leer la tubería
+        progress_writer.send(None)
+        progress_writer.close()
+
+
+def _receive_progress(progress_reader):
+    """Se ejecuta en _progress_executor: siguiente valor de progreso, o _NO_PROGRESS"""
+    if progress_reader.poll(PROGRESS_POLL_SECONDS):
+        return progress_reader.recv()
+    return _NO_PROGRESS
+
+
+async def run_in_worker_with_progress(func, *args, on_progress):
+    """Como run_in_worker, pero func recibe un callback extra cuyos valores
+    llegan a on_progress en el event loop mientras el análisis avanza"""
+    loop = asyncio.get_running_loop()
+    # Tubería de un solo sentido (worker -> proceso principal), sin proceso Manager intermedio
+    progress_reader, progress_writer = multiprocessing.get_context("spawn").Pipe(duplex=False)
+    try:
+        future = asyncio.ensure_future(run_in_worker(_call_with_progress, progress_writer, func, args))
+
+        while True:
+            item = await loop.run_in_executor(_progress_executor, _receive_progress, progress_reader)
+            if item is _NO_PROGRESS:
+                if future.done():
+                    break
+                continue
+            if item is None:
+                break
+            on_progress(item)
+
+        return await future
+    finally:
+        progress_reader.close()
+        progress_writer.close()
@@ -0,0 +1,225 @@
+import os
+import time
+import yt_dlp
+from yt_dlp.utils import DownloadCancelled, DownloadError, download_range_func
+from fastapi import HTTPException
+from app.cache import normalize_youtube_id
+from app.ttl_cache import TTLCache
+from app.config import (
+    YOUTUBE_METADATA_CACHE_MAX_ENTRIES, YOUTUBE_METADATA_TTL_SECONDS, MAX_AUDIO_DURATION_SECONDS
+)
+from app.uploads import raise_too_long
+
+TITLE_NOT_FOUND = "Título no encontrado"
+DOWNLOAD_TIMEOUT_SECONDS = 180
+AUDIO_EXTENSIONS = ('.webm', '.m4a', '.mp3', '.opus', '.ogg', '.wav')
+
+# Opciones equivalentes al comando de yt-dlp que se usaba por subproceso
+# (actualizadas para compatibilidad con restricciones de YouTube, dic 2025)
+BASE_OPTIONS = {
+    "nocheckcertificate": True,
+    "noplaylist": True,
+    "quiet": True,
+    "no_warnings": True,
+    "noprogress": True,
+    "socket_timeout": 30,
+}
+PRIMARY_OPTIONS = {
+    **BASE_OPTIONS,
+    "http_headers": {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    },
+    "extractor_args": {"youtube": {"player_client": ["web"]}},
+}
+# Configuración alternativa si la principal falla
+FALLBACK_OPTIONS = BASE_OPTIONS
+
+# Metadatos por vídeo (título, duración): las peticiones repetidas no salen a la red
+_metadata_cache = TTLCache(YOUTUBE_METADATA_CACHE_MAX_ENTRIES, YOUTUBE_METADATA_TTL_SECONDS)
+
+
+# ----------------------------
+# Metadatos
+# ----------------------------
+def _metadata_key(youtube_url: str) -> str:
+    video_id = normalize_youtube_id(youtube_url)
+    return f"yt:{video_id}" if video_id else f"url:{youtube_url.strip()}"
+
+
+def remember_metadata(youtube_url: str, info: dict) -> dict:
+    """Guarda en caché los metadatos útiles de la respuesta de yt-dlp"""
+    metadata = {
+        "id": info.get("id"),
+        "title": info.get("title") or TITLE_NOT_FOUND,
+        "duration": info.get("duration"),
+        "is_live": bool(info.get("is_live")),
+    }
+    _metadata_cache.put(_metadata_key(youtube_url), metadata)
+    return metadata
+
+
+def cached_metadata(youtube_url: str):
+    return _metadata_cache.get(_metadata_key(youtube_url))
+
+
+# ----------------------------
+# Comprobación previa de la duración
+# ----------------------------
+def window_length(duration: float, start: float = None, end: float = None) -> float:
+    """Segundos que se van a analizar del vídeo (todo o el fragmento start/end)"""
+    if end is None or end > duration:
+        end = duration
+    return max(end - (start or 0), 0)
+
+
+def duration_problem(metadata: dict, start: float = None, end: float = None):
+    """Motivo para no descargar el vídeo, o None si se puede analizar"""
+    if metadata.get("is_live"):
+        return "Las emisiones en directo no se pueden analizar."
+    duration = metadata.get("duration")
+    if MAX_AUDIO_DURATION_SECONDS and duration and window_length(duration, start, end) > MAX_AUDIO_DURATION_SECONDS:
+        return "too_long"
+    return None
+
+
+def check_metadata(metadata: dict, start: float = None, end: float = None):
+    problem = duration_problem(metadata, start, end)
+    if problem == "too_long":
+        raise_too_long(window_length(metadata["duration"], start, end))
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+
+
+# ----------------------------
+# Descarga (metadatos y audio en una sola extracción)
+# ----------------------------
+def _deadline_hook(deadline: float):
+    def hook(progress: dict):
+        if time.monotonic() > deadline:
+            raise DownloadCancelled("Tiempo de descarga excedido")
+    return hook
+
+
+def _find_downloaded(info: dict, output_dir: str):
+    for download in info.get("requested_downloads") or []:
+        path = download.get("filepath")
+        if path and os.path.exists(path):
+            return path
+    for f in os.listdir(output_dir):
+        if f.endswith(AUDIO_EXTENSIONS):
+            return os.path.join(output_dir, f)
+    return None
+
+
+def download_audio(youtube_url: str, output_dir: str, start: float = None, end: float = None):
+    """Descarga el mejor audio del vídeo con yt-dlp como librería.
+
+    Devuelve (metadatos, ruta del audio). Se ejecuta fuera del event loop
+    (asyncio.to_thread): la página del vídeo se resuelve una sola vez para
+    obtener el título y el audio.
+
+    La duración se comprueba antes de descargar nada (con los metadatos en
+    caché o, si no, tras resolver la página). Con start/end solo se descarga
+    ese fragmento del vídeo.
+    """
+    cached = cached_metadata(youtube_url)
+    if cached:
+        check_metadata(cached, start, end)
+
+    os.makedirs(output_dir, exist_ok=True)
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT_SECONDS
+
+    rejected = []
+
+    def match_filter(info_dict, *, incomplete=False):
+        # yt-dlp lo llama con los metadatos, antes de empezar la descarga
+        metadata = remember_metadata(youtube_url, info_dict)
+        if duration_problem(metadata, start, end):
+            rejected.append(metadata)
+            return "Vídeo rechazado por su duración"
+        return None
+
+    info = None
+    error = None
+    for options in (PRIMARY_OPTIONS, FALLBACK_OPTIONS):
+        options = {
+            **options,
+            "format": "bestaudio/best",
+            "outtmpl": os.path.join(output_dir, "audio.%(ext)s"),
+            "progress_hooks": [_deadline_hook(deadline)],
+            "match_filter": match_filter,
+        }
+        if start is not None or end is not None:
+            # Descarga por secciones (usa ffmpeg): solo se transfiere el fragmento pedido
+            options["download_ranges"] = download_range_func(
+                None, [(start or 0, float("inf") if end is None else end)]
+            )
+        try:
+            with yt_dlp.YoutubeDL(options) as ydl:
+                info = ydl.extract_info(youtube_url, download=True)
+            break
+        except DownloadCancelled:
+            raise HTTPException(
+                status_code=408,
+                detail="Tiempo de descarga excedido. El video es demasiado largo o la conexión es lenta."
+            )
+        except DownloadError as e:
+            error = e
+
+    if rejected:
+        check_metadata(rejected[0], start, end)
+
+    if info is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"No se pudo descargar el audio. El vídeo puede tener copyright o protección.\nDetalles: {error}"
+        )
+
+    metadata = remember_metadata(youtube_url, info)
+    actual_path = _find_downloaded(info, output_dir)
+    if not actual_path:
+        raise HTTPException(
+            status_code=400,
+            detail="YouTube no proporcionó ningún archivo de audio sin protección."
+        )
+
+    if os.path.getsize(actual_path) < 8000:
+        raise HTTPException(
+            status_code=400,
+            detail="Audio inválido o vacío. El vídeo no permite descarga legal."
+        )
+
+    return metadata, actual_path
+
+
+# ----------------------------
+# Playlists
+# ----------------------------
+def expand_playlist(playlist_url: str, limit: int) -> list:
+    """Devuelve [(url, título)] de los vídeos de una playlist sin descargarlos"""
+    options = {
+        **PRIMARY_OPTIONS,
+        "noplaylist": False,
+        "extract_flat": "in_playlist",
+        "playlistend": limit,
+    }
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(playlist_url, download=False)
+    except DownloadError as e:
+        raise HTTPException(status_code=400, detail=f"No se pudo leer la playlist.\nDetalles: {e}")
+
+    # Un enlace a un solo vídeo devuelve el vídeo sin "entries"
+    entries = info.get("entries") if "entries" in info else [info]
+    videos = []
+    for entry in entries or []:
+        if not entry:
+            continue
+        url = entry.get("webpage_url") or entry.get("url")
+        if not url and entry.get("id"):
+            url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if url:
+            # La playlist ya trae título y duración de cada vídeo
+            remember_metadata(url, entry)
+            videos.append((url, entry.get("title")))
+    return videos[:limit]
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Benchmark reproducible del analizador (app/analyzer.py) con canciones sintéticas
+
+Genera canciones deterministas por síntesis aditiva (progresión, tempo y compás
+conocidos), las analiza con analyze_audio_advanced y mide el tiempo de cada
+etapa, la memoria máxima, el rendimiento (segundos de audio por segundo) y la
+precisión de los acordes frente a la progresión real. La salida es JSON para
+poder comparar ejecuciones:
+
+    python benchmark_analyzer.py --output antes.json
+    python benchmark_analyzer.py --output despues.json --compare antes.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import librosa
+import numpy as np
+import soundfile as sf
+from app.analyzer import analyze_audio_advanced, ANALYZER_VERSION, SAMPLE_RATE
+from app.chords import ROOTS, CHORD_INTERVALS
+
+# Progresiones de prueba: (fundamental, tipo) por compás, en bucle
+PROGRESSIONS = {
+    "pop": [("C", ""), ("G", ""), ("A", "m"), ("F", "")],
+    "jazz": [("D", "m7"), ("G", "7"), ("C", "maj7"), ("A", "7")],
+    "minor": [("A", "m"), ("F", ""), ("C", ""), ("G", "")],
+    "blues": [("E", "7"), ("A", "7"), ("E", "7"), ("B", "7")],
+}
+
+# Casos del benchmark: progresión, tempo, beats por compás y duración en segundos
+CASES = [
+    {"progression": "pop", "bpm": 100, "beats_per_bar": 4, "duration": 30},
+    {"progression": "minor", "bpm": 84, "beats_per_bar": 3, "duration": 60},
+    {"progression": "jazz", "bpm": 120, "beats_per_bar": 4, "duration": 180},
+    {"progression": "blues", "bpm": 96, "beats_per_bar": 4, "duration": 300},
+    {"progression": "pop", "bpm": 110, "beats_per_bar": 4, "duration": 600},
+]
+
+QUICK_MAX_DURATION = 60
+
+
+# ----------------------------
+# Síntesis de canciones
+# ----------------------------
+def synthesize_song(progression: list, bpm: float, beats_per_bar: int, duration: float, seed: int = 0):
+    """Sintetiza la canción y devuelve (pcm float32, lista de (inicio, fin, acorde) reales)"""
+    rng = np.random.default_rng(seed)
+    beat_seconds = 60.0 / bpm
+    bar_seconds = beat_seconds * beats_per_bar
+    n_samples = int(duration * SAMPLE_RATE)
+    y = np.zeros(n_samples, dtype=np.float32)
+
+    bar_samples = int(round(bar_seconds * SAMPLE_RATE))
+    t = np.arange(bar_samples) / SAMPLE_RATE
+
+    # Envolvente del compás: ataque en cada beat, más fuerte en el primero
+    envelope = np.full(bar_samples, 0.6, dtype=np.float32)
+    attack = int(0.08 * SAMPLE_RATE)
+    for beat in range(beats_per_bar):
+        start = int(round(beat * beat_seconds * SAMPLE_RATE))
+        length = min(attack, bar_samples - start)
+        envelope[start:start + length] += np.linspace(1.5 if beat == 0 else 0.8, 0.0, length)
+
+    truth = []
+    for bar_idx in range(int(np.ceil(duration / bar_seconds))):
+        root, chord_type = progression[bar_idx % len(progression)]
+        root_idx = ROOTS.index(root)
+        segment = np.zeros(bar_samples, dtype=np.float64)
+        # Notas del acorde con parciales en octavas (no añaden otras clases de altura)
+        for semitone, weight in CHORD_INTERVALS[chord_type]:
+            freq = 261.63 * 2 ** ((root_idx + semitone) / 12)
+            for harmonic, amplitude in ((1, 1.0), (2, 0.5), (4, 0.25)):
+                segment += 0.15 * weight * amplitude * np.sin(2 * np.pi * freq * harmonic * t)
+        # Bajo en la fundamental
+        segment += 0.3 * np.sin(2 * np.pi * 65.41 * 2 ** (root_idx / 12) * t)
+
+        start = bar_idx * bar_samples
+        end = min(start + bar_samples, n_samples)
+        if start >= n_samples:
+            break
+        y[start:end] += (segment * envelope)[:end - start].astype(np.float32)
+        truth.append((start / SAMPLE_RATE, end / SAMPLE_RATE, root + chord_type))
+
+    y += 0.01 * rng.standard_normal(n_samples).astype(np.float32)
+    y *= 0.8 / np.abs(y).max()
+    return y, truth
+
+
+# ----------------------------
+# Precisión
+# ----------------------------
+def chord_root(chord: str) -> str:
+    return chord[:2] if chord[1:2] == "#" else chord[:1]
+
+
+def score_chords(detected: list, truth: list) -> dict:
+    """Proporción del tiempo con el acorde (y la fundamental) correctos.
+
+    Cada compás detectado se compara con el acorde real en su punto medio,
+    ponderado por su duración.
+    """
+    truth_starts = [start for start, _, _ in truth]
+    total = exact = same_root = 0.0
+    for bar in detected:
+        length = bar["end_time"] - bar["start_time"]
+        middle = (bar["start_time"] + bar["end_time"]) / 2
+        idx = max(np.searchsorted(truth_starts, middle, side="right") - 1, 0)
+        expected = truth[idx][2]
+        total += length
+        if bar["chord"] == expected:
+            exact += length
+        if bar["chord"] != "N.C." and chord_root(bar["chord"]) == chord_root(expected):
+            same_root += length
+    return {
+        "chord": round(exact / total, 4) if total else 0.0,
+        "root": round(same_root / total, 4) if total else 0.0,
+    }
+
+
+# ----------------------------
+# Ejecución
+# ----------------------------
+def run_case(case: dict, vocabulary: str, repeat: int) -> dict:
+    progression = PROGRESSIONS[case["progression"]]
+    y, truth = synthesize_song(progression, case["bpm"], case["beats_per_bar"], case["duration"])
+
+    # Se analiza desde un archivo, como en el pipeline: ffmpeg lo decodifica bloque
+    # a bloque y la memoria máxima incluye todo (no hay PCM completo en memoria)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        song_path = os.path.join(tmp_dir, "song.wav")
+        sf.write(song_path, y, SAMPLE_RATE, subtype="FLOAT")
+        del y
+
+        runs = []
+        for _ in range(repeat):
+            timings = {}
+            tracemalloc.start()
+            started = time.perf_counter()
+            result = analyze_audio_advanced(song_path, vocabulary, timings=timings)
+            wall = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            runs.append((wall, timings, peak))
+
+    # Mediana de las repeticiones (la memoria máxima es la mayor de todas)
+    wall = statistics.median(w for w, _, _ in runs)
+    stages = {stage: round(statistics.median(t[stage] for _, t, _ in runs), 4) for stage in runs[0][1]}
+    peak = max(p for _, _, p in runs)
+
+    return {
+        "name": f"{case['progression']}-{case['bpm']}bpm-{case['beats_per_bar']}_4-{case['duration']}s",
+        **case,
+        "vocabulary": vocabulary,
+        "wall_time": round(wall, 4),
+        "stages": stages,
+        "peak_memory_mb": round(peak / (1024 * 1024), 1),
+        "throughput": round(case["duration"] / wall, 2),
+        "accuracy": score_chords(result["chords"], truth),
+        "tempo_detected": result["tempo_bpm"],
+        "beats_per_bar_detected": result["beats_per_bar"],
+    }
+
+
+def compare(current: dict, previous: dict):
+    """Imprime la variación de tiempo y precisión respecto a otra ejecución"""
+    previous_cases = {(c["name"], c["vocabulary"]): c for c in previous["cases"]}
+    print(f"{'caso':<40} {'tiempo':>10} {'rendimiento':>12} {'precisión':>10}", file=sys.stderr)
+    for case in current["cases"]:
+        old = previous_cases.get((case["name"], case["vocabulary"]))
+        if not old:
+            continue
+        speedup = old["wall_time"] / case["wall_time"] if case["wall_time"] else 0.0
+        accuracy_delta = case["accuracy"]["chord"] - old["accuracy"]["chord"]
+        print(
+            f"{case['name']:<40} {case['wall_time']:>9.2f}s {speedup:>11.2f}x {accuracy_delta:>+10.3f}",
+            file=sys.stderr
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del analizador de acordes")
+    parser.add_argument("--quick", action="store_true", help=f"Solo canciones de hasta {QUICK_MAX_DURATION} s")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticiones por caso (se usa la mediana)")
+    parser.add_argument("--vocabulary", default="basic", choices=["basic", "extended"])
+    parser.add_argument("--output", help="Archivo JSON de resultados (por defecto, salida estándar)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if not args.quick or c["duration"] <= QUICK_MAX_DURATION]
+
+    # Calentamiento: plantillas, cachés de librosa y compilación de numba
+    warmup, _ = synthesize_song(PROGRESSIONS["pop"], 100, 4, 10)
+    analyze_audio_advanced(warmup, args.vocabulary)
+
+    results = []
+    for case in cases:
+        print(f"Analizando {case['progression']} ({case['duration']} s)...", file=sys.stderr)
+        results.append(run_case(case, args.vocabulary, args.repeat))
+
+    report = {
+        "analyzer_version": ANALYZER_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "librosa": librosa.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "repeat": args.repeat,
+        "cases": results,
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,8 @@ import os
 # Agregar el directorio del proyecto al path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app.database import engine, Base
+from app.database import engine, Base, upgrade_schema
+from app.refresh_tokens import import_legacy_refresh_tokens
 from app.config import DATABASE_URL, IS_PRODUCTION
 
 def init_db():
@@ -22,6 +23,15 @@ def init_db():
         Base.metadata.create_all(bind=engine)
         print("✅ Tablas de base de datos creadas exitosamente")
         
+        # Actualizar tablas creadas con versiones anteriores del modelo
+        upgrade_schema()
+        print("✅ Esquema actualizado")
+        
+        # Refresh tokens de la tabla antigua (en claro) a la nueva (hasheados)
+        imported = import_legacy_refresh_tokens()
+        if imported:
+            print(f"✅ {imported} refresh tokens activos migrados a auth_refresh_tokens")
+        
     except Exception as e:
         print(f"❌ Error inicializando base de datos: {e}")
         sys.exit(1)
@@ -1,13 +1,31 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from app.auth_routes import router as auth_router
 from app.analize_routes import router as analize_router
-from app.config import CORS_ORIGINS, IS_PRODUCTION
+from app.async_database import async_engine
+from app.config import CORS_ORIGINS, IS_PRODUCTION, UPLOAD_MAX_BYTES, BATCH_MAX_FILES
+from app.metrics import render_metrics
+from app.refresh_tokens import run_refresh_token_sweeper
+from app.workers import shutdown_workers
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Borrado periódico de refresh tokens caducados o revocados
+    sweeper = asyncio.create_task(run_refresh_token_sweeper())
+    yield
+    sweeper.cancel()
+    # Cerrar el pool de procesos de análisis al apagar el servidor
+    shutdown_workers()
+    # Cerrar las conexiones del motor asíncrono
+    await async_engine.dispose()
 
 app = FastAPI(
     title="ChordMaster Backend", 
     version="1.0.0",
+    lifespan=lifespan,
     docs_url="/docs" if not IS_PRODUCTION else None,  # Ocultar docs en producción
     redoc_url="/redoc" if not IS_PRODUCTION else None
 )
@@ -52,6 +70,27 @@ async def handle_options(request: Request, full_path: str):
         }
     )
 
+# Margen para los límites y campos del multipart además del archivo
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Rechaza por Content-Length las subidas demasiado grandes antes de leer el cuerpo"""
+    content_length = request.headers.get("content-length", "")
+    # Los lotes de archivos admiten varios archivos por petición
+    max_files = BATCH_MAX_FILES if request.url.path.endswith("/batches/files") else 1
+    if (
+        request.method == "POST"
+        and content_length.isdigit()
+        and int(content_length) > (UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES) * max_files
+    ):
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"El archivo supera el tamaño máximo permitido ({UPLOAD_MAX_BYTES // (1024 * 1024)} MB)."},
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+    return await call_next(request)
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -67,3 +106,8 @@ app.include_router(analize_router, prefix="/api/analyze", tags=["analyze"])
 async def root():
     return {"message": "ChordMaster Backend API", "version": "1.0.0"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Métricas del pipeline de análisis en formato Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Script para mover el audio guardado en song_history al almacenamiento de audio
+y recomprimir el audio ya guardado con el códec configurado (AUDIO_STORAGE_CODEC)
+"""
+import sys
+import os
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.database import SessionLocal, SongHistory, upgrade_schema
+from app.storage import get_storage, store_audio, migrate_song_audio, release_audio
+from app.audio_codec import encode_audio, decode_audio_bytes
+from app.config import AUDIO_STORAGE_BACKEND, AUDIO_STORAGE_CODEC
+
+# Filas por consulta: solo se carga en memoria el audio de una fila a la vez
+BATCH_SIZE = 50
+
+def migrate_audio():
+    """Mover los WAV de las filas antiguas al almacenamiento configurado"""
+    try:
+        print(f"Migrando audio al almacenamiento '{AUDIO_STORAGE_BACKEND}'...")
+        upgrade_schema()
+        
+        db = SessionLocal()
+        try:
+            moved = 0
+            last_id = 0
+            while True:
+                ids = [row.id for row in db.query(SongHistory.id).filter(
+                    SongHistory.id > last_id,
+                    SongHistory.audio_key.is_(None),
+                    SongHistory.audio_data.isnot(None)
+                ).order_by(SongHistory.id).limit(BATCH_SIZE)]
+                if not ids:
+                    break
+                for song_id in ids:
+                    if migrate_song_audio(db, song_id):
+                        moved += 1
+                    # Liberar el audio ya migrado de la sesión
+                    db.expunge_all()
+                last_id = ids[-1]
+                print(f"  {moved} canciones migradas")
+        finally:
+            db.close()
+        
+        print(f"✅ Migración completada: {moved} canciones")
+        
+    except Exception as e:
+        print(f"❌ Error migrando audio: {e}")
+        sys.exit(1)
+
+def recompress_audio():
+    """Recomprimir con AUDIO_STORAGE_CODEC el audio guardado con otro códec"""
+    print(f"Recomprimiendo audio a '{AUDIO_STORAGE_CODEC}'...")
+    storage = get_storage()
+    db = SessionLocal()
+    try:
+        done = 0
+        saved_bytes = 0
+        failed = set()
+        while True:
+            # Cada clave puede estar compartida por varias filas (análisis reutilizados)
+            keys = [row.audio_key for row in db.query(SongHistory.audio_key).filter(
+                SongHistory.audio_key.isnot(None),
+                SongHistory.audio_key.notin_(failed),
+                SongHistory.audio_codec != AUDIO_STORAGE_CODEC
+            ).distinct().limit(BATCH_SIZE)]
+            if not keys:
+                break
+            for old_key in keys:
+                try:
+                    old_data = storage.get(old_key)
+                    new_data = encode_audio(decode_audio_bytes(old_data), AUDIO_STORAGE_CODEC)
+                    new_key = store_audio(new_data)
+                except Exception as e:
+                    print(f"  ⚠️ No se pudo recomprimir {old_key}: {e}")
+                    failed.add(old_key)
+                    continue
+                db.query(SongHistory).filter(SongHistory.audio_key == old_key).update({
+                    "audio_key": new_key,
+                    "audio_size": len(new_data),
+                    "audio_codec": AUDIO_STORAGE_CODEC,
+                }, synchronize_session=False)
+                db.commit()
+                release_audio(db, old_key)
+                done += 1
+                saved_bytes += len(old_data) - len(new_data)
+            print(f"  {done} archivos recomprimidos ({saved_bytes / (1024 * 1024):.1f} MB ahorrados)")
+    finally:
+        db.close()
+    
+    print(f"✅ Recompresión completada: {done} archivos, {len(failed)} con errores")
+
+if __name__ == "__main__":
+    migrate_audio()
+    recompress_audio()